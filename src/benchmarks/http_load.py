@@ -0,0 +1,98 @@
+"""
+HTTP load generator to compare the WSGI and ASGI deployments of the API.
+
+Start both servers with one worker process, for example:
+
+    gunicorn config.wsgi --workers 1 --threads 8 --bind 127.0.0.1:8001
+    uvicorn config.asgi:application --workers 1 --port 8002
+
+and run:
+
+    python benchmarks/http_load.py \
+        wsgi=http://127.0.0.1:8001/book/ \
+        asgi=http://127.0.0.1:8002/async/book/ \
+        --concurrency 200 --requests 5000 --slow 0.05
+
+--slow makes every client send its request headers line by line with
+a delay, like clients on slow networks. Results are printed as JSON.
+Only the standard library is used.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def fetch(url, slow):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname,
+                                                   parts.port or 80)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    lines = [f'GET {path} HTTP/1.1', f'Host: {parts.netloc}',
+             'Connection: close', '']
+    try:
+        for line in lines:
+            writer.write(f'{line}\r\n'.encode())
+            await writer.drain()
+            if slow:
+                await asyncio.sleep(slow)
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def run(url, concurrency, requests, slow):
+    latencies = []
+    errors = 0
+    queue = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for _ in queue:
+            started_at = time.perf_counter()
+            try:
+                status = await fetch(url, slow)
+            except (OSError, ValueError, IndexError):
+                status = None
+            latencies.append(time.perf_counter() - started_at)
+            if status != 200:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started_at
+    latencies.sort()
+    return {
+        'url': url,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'requests_per_second': round(requests / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('targets', nargs='+', help='name=url')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--slow', type=float, default=0,
+                        help='Delay between request header lines, seconds')
+    args = parser.parse_args()
+
+    results = {}
+    for target in args.targets:
+        name, _, url = target.partition('=')
+        results[name] = asyncio.run(run(url or name, args.concurrency,
+                                        args.requests, args.slow))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ load_dotenv()
 BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.getenv('DJANGO_SECRET_KEY')
 DEBUG = True
+DEBUG_TOOLBAR = DEBUG and os.getenv('DJANGO_DEBUG_TOOLBAR') == '1'
 ALLOWED_HOSTS = ['127.0.0.1',]
 INTERNAL_IPS = ['127.0.0.1',]
 
@@ -18,13 +19,17 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
 
-    'debug_toolbar',
     'social_django',
-    
+
     'store',
 ]
 
+# all middlewares are async capable, so async views run concurrently
+# under ASGI
 MIDDLEWARE = [
+    'store.middleware.LogContextMiddleware',
+    'store.middleware.InstrumentationMiddleware',
+    'store.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -32,10 +37,15 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
-    'debug_toolbar_force.middleware.ForceDebugToolbarMiddleware',
 ]
 
+if DEBUG_TOOLBAR:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE += [
+        'debug_toolbar.middleware.DebugToolbarMiddleware',
+        'debug_toolbar_force.middleware.ForceDebugToolbarMiddleware',
+    ]
+
 ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
@@ -60,6 +70,33 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # seconds a connection waits for a lock instead of failing
+            # with "database is locked"
+            'timeout': 20,
+        },
+    }
+}
+
+# Local SQLite copy as a read replica, refreshed by `manage.py sync_replica`
+if os.getenv('DJANGO_DB_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('DJANGO_DB_REPLICA'),
+        'OPTIONS': {'timeout': 20},
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['store.routers.ReplicaRouter']
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'library',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
     }
 }
 
@@ -110,6 +147,62 @@ REST_FRAMEWORK = {
     ),
 }
 
+STORE_CACHE_ALIAS = 'default'
+STORE_READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+STORE_REPLICA_STICKY_SECONDS = 10
+# responses read from replicas are cached apart and for at most
+# STORE_REPLICA_STICKY_SECONDS, as they may lag behind the books version
+STORE_RESPONSE_CACHE_TIMEOUT = 60
+# run async views in the shared sync thread instead of a thread pool
+STORE_ASYNC_THREAD_SENSITIVE = False
+# max queries of anonymous requests to views, 'log' or 'raise' when exceeded,
+# authenticated requests also load the session and the user and are skipped
+STORE_QUERY_BUDGETS = {
+    'BookViewSet.list': 2,
+    'BookViewSet.retrieve': 3,
+    'BookViewSet.readers': 3,
+    'BookViewSet.leaderboard': 2,
+    'BookViewSet.similar': 1,
+    'BookViewSet.facets': 1,
+}
+STORE_QUERY_BUDGET_ACTION = 'log'
+# log every request with its view, user, duration and queries
+STORE_REQUEST_LOG = True
+# part of rating changes logged as `rating_changed` events
+STORE_RATING_EVENT_SAMPLE_RATE = 0.1
+# pragmas of every new SQLite connection: WAL lets readers work during
+# a write, synchronous=normal is durable enough in WAL mode
+STORE_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,  # KiB
+    'mmap_size': 256 * 1024 * 1024,
+}
+# run relation writes in one worker thread, committing queued writes
+# together, so request threads never wait for the SQLite write lock
+STORE_WRITE_QUEUE = os.getenv('DJANGO_WRITE_QUEUE') == '1'
+STORE_WRITE_QUEUE_BATCH_SIZE = 100
+# seconds the worker waits for more writes before a commit
+STORE_WRITE_QUEUE_WAIT = 0.002
+# seconds a request waits for its queued write before giving up
+STORE_WRITE_QUEUE_TIMEOUT = 30.0
+# recompute book counters in a background thread instead of updating
+# the book row on every relation write. Books queued at exit are flushed,
+# after a crash run `manage.py reconcile_ratings --counters`
+STORE_COUNTERS_WRITE_BEHIND = os.getenv('DJANGO_COUNTERS_WRITE_BEHIND') == '1'
+# seconds counters of a book may lag behind its relations
+STORE_COUNTERS_MAX_STALENESS = 1.0
+STORE_COUNTERS_BATCH_SIZE = 500
+# seconds leaderboards may lag behind relations
+STORE_LEADERBOARD_MAX_STALENESS = 5.0
+STORE_TOP_RATED_MIN_VOTES = 5
+# trending books are ranked by relation changes in this many last hours
+STORE_TRENDING_HOURS = 24
+# bounds of price ranges of the price facet and number of top authors
+# in the author facet
+STORE_PRICE_FACET_BOUNDS = (500, 1000, 2000)
+STORE_AUTHOR_FACET_SIZE = 20
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -121,23 +214,19 @@ LOGGING = {
             '()': 'django.utils.log.RequireDebugTrue',
         },
     },
-    'formatters': {
-        'custom': {
-            'format': '{levelname} [{asctime}] ({message}) [{filename} {funcName}]',
-            'style': '{'
-        },
-    },
     'handlers': {
         'console': {
             'level': 'INFO',
             'filters': ['require_debug_true'],
             'class': 'logging.StreamHandler',
         },
+        # JSON lines written by a background thread, see store.log
         'file_store': {
             'level': 'DEBUG',
-            'class': 'logging.FileHandler',
+            '()': 'store.log.get_queue_handler',
             'filename': os.path.join(BASE_DIR, './logs/store.log'),
-            'formatter': 'custom'
+            'max_bytes': 50 * 1024 * 1024,
+            'backup_count': 5,
         },
     },
     'loggers': {
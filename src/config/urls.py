@@ -3,21 +3,30 @@ from django.conf.urls import url
 from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import SimpleRouter
-from store.views import BookViewSet, auth, UserBookRelationView
+from store import async_views
+from store.views import (BookViewSet, auth, metrics, UserBookRelationView,
+                         UserLibraryView)
 
 router = SimpleRouter()
 router.register(r'book', BookViewSet)
 router.register(r'book_relation', UserBookRelationView)
+router.register(r'me/library', UserLibraryView, basename='library')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     url('', include('social_django.urls', namespace='social')),
     path('auth/', auth),
+    path('metrics/', metrics),
+    path('async/book/', async_views.book_list, name='async-book-list'),
+    path('async/book/<int:pk>/', async_views.book_detail,
+         name='async-book-detail'),
+    path('async/book_relation/<int:book>/', async_views.book_relation,
+         name='async-book-relation'),
 ]
 
 urlpatterns += router.urls
 
-if settings.DEBUG:
+if settings.DEBUG_TOOLBAR:
     import debug_toolbar
     urlpatterns = [
         path('__debug__/', include(debug_toolbar.urls)),
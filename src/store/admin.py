@@ -2,13 +2,18 @@ from django.contrib import admin
 from django.contrib.admin import ModelAdmin
 
 from store.models import Book, UserBookRelation
+from store.services.relation import delete_relations
 
 
 @admin.register(Book)
 class BookAdmin(ModelAdmin):
-    pass
+    # counters are kept by relation writes, not edited by hand
+    readonly_fields = ('rating', 'rating_sum', 'rating_count',
+                       *Book.RATE_COUNT_FIELDS.values(), 'likes_count',
+                       'readers_count')
 
 
 @admin.register(UserBookRelation)
 class UserBookRelationAdmin(ModelAdmin):
-    pass
+    def delete_queryset(self, request, queryset):
+        delete_relations(queryset)
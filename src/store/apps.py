@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class StoreConfig(AppConfig):
     name = 'store'
+
+    def ready(self):
+        import store.signals  # noqa: F401
+        post_migrate.connect(repair_search_index, sender=self)
+
+
+def repair_search_index(using, **kwargs):
+    from store.search import repair_sqlite_fts
+    repair_sqlite_fts(using)
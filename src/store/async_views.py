@@ -0,0 +1,46 @@
+"""
+Async variants of the book API for the ASGI deployment (config/asgi.py).
+
+Under ASGI Django runs every sync view in one shared thread, so requests
+wait for each other on the database. These views keep the event loop free
+for slow clients and run the whole DRF view, with all its ORM work, as one
+call in a thread pool, so several requests use the database at once.
+This only holds while every middleware in settings.MIDDLEWARE is async
+capable: a sync one keeps the shared thread busy until the view returns.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from store.views import BookViewSet, UserBookRelationView
+
+
+def run_in_thread_pool(view):
+    def run(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+        return response
+
+    def run_and_close(request, *args, **kwargs):
+        try:
+            return run(request, *args, **kwargs)
+        finally:
+            # pool threads are not closed by request_finished signal
+            close_old_connections()
+
+    @wraps(view)
+    async def async_view(request, *args, **kwargs):
+        if settings.STORE_ASYNC_THREAD_SENSITIVE:
+            return await sync_to_async(run)(request, *args, **kwargs)
+        return await sync_to_async(run_and_close, thread_sensitive=False)(
+            request, *args, **kwargs)
+    return async_view
+
+
+book_list = run_in_thread_pool(BookViewSet.as_view({'get': 'list'}))
+book_detail = run_in_thread_pool(BookViewSet.as_view({'get': 'retrieve'}))
+book_relation = run_in_thread_pool(UserBookRelationView.as_view(
+    {'patch': 'partial_update', 'put': 'update'}))
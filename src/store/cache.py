@@ -0,0 +1,146 @@
+import hashlib
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+from store.routers import reads_from_replicas
+
+BOOKS_VERSION_KEY = 'store:books:version'
+
+
+class CacheStats:
+    """In-process hit/miss counters of the books response cache"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+cache_stats = CacheStats()
+
+
+def get_cache():
+    return caches[settings.STORE_CACHE_ALIAS]
+
+
+def get_books_version():
+    cache = get_cache()
+    version = cache.get(BOOKS_VERSION_KEY)
+    if version is None:
+        # starting from the current time, a version evicted from the cache
+        # never comes back and never matches old responses
+        cache.add(BOOKS_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(BOOKS_VERSION_KEY)
+    return version
+
+
+def bump_books_version():
+    try:
+        get_cache().incr(BOOKS_VERSION_KEY)
+    except ValueError:
+        get_books_version()
+
+
+def invalidate_books():
+    """
+    Make all cached book responses stale. The version is bumped once more
+    after commit, so readers can not cache data of the transaction in progress
+    under the new version
+    """
+    bump_books_version()
+    if connection.in_atomic_block:
+        transaction.on_commit(bump_books_version)
+
+
+def get_response_key(request, action, kwargs):
+    query = sorted((key, value) for key in request.query_params
+                   for value in request.query_params.getlist(key))
+    return get_books_key((request.get_host(), request.path, action,
+                          sorted(kwargs.items()), query))
+
+
+def get_books_key(normalized):
+    # data of lagging replicas is cached apart, clients sticky to
+    # the primary database never read it
+    source = 'replica' if reads_from_replicas() else 'primary'
+    digest = hashlib.md5(repr(normalized).encode()).hexdigest()
+    return f'store:books:{get_books_version()}:{source}:{digest}'
+
+
+def get_cached(key):
+    """Cached data of books under the key, counted as a hit or a miss"""
+    data = get_cache().get(key)
+    if data is None:
+        cache_stats.miss()
+    else:
+        cache_stats.hit()
+    return data
+
+
+def set_cached(key, data):
+    """
+    Cache data of books. A lagging replica may put old data under the new
+    version, so data of replicas is cached for at most
+    STORE_REPLICA_STICKY_SECONDS, the replication lag the sticky cookie
+    assumes: it is as stale as an uncached replica read for that long
+    """
+    timeout = settings.STORE_RESPONSE_CACHE_TIMEOUT
+    if reads_from_replicas():
+        timeout = min(timeout, settings.STORE_REPLICA_STICKY_SECONDS)
+    get_cache().set(key, data, timeout=timeout)
+
+
+def get_or_set_books_data(name, params, get_data):
+    """
+    Data of books by `get_data()` cached for the params, whatever order
+    they come in, until any book or relation is changed
+    """
+    if not settings.STORE_RESPONSE_CACHE_TIMEOUT:
+        return get_data()
+    key = get_books_key((name, sorted(params)))
+    data = get_cached(key)
+    if data is None:
+        data = get_data()
+        set_cached(key, data)
+    return data
+
+
+def cache_books_response(view_method):
+    """
+    Cache data of successful responses of the book view action, until any
+    book or relation is changed
+    """
+    @wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        if not settings.STORE_RESPONSE_CACHE_TIMEOUT:
+            return view_method(view, request, *args, **kwargs)
+
+        key = get_response_key(request, view.action, kwargs)
+        data = get_cached(key)
+        if data is not None:
+            return Response(data)
+
+        response = view_method(view, request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            set_cached(key, response.data)
+        return response
+    return wrapper
@@ -0,0 +1,45 @@
+import hashlib
+from functools import wraps
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+def get_etag(*parts):
+    return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+def conditional_response(validators_method):
+    """
+    Answer GET with 304 Not Modified by If-None-Match/If-Modified-Since
+    before the response is built. `validators_method` is the name of the
+    view method which returns (etag, last_modified) or None
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(view, request, *args, **kwargs):
+            validators = None
+            if request.method in ('GET', 'HEAD'):
+                validators = getattr(view, validators_method)(
+                    request, *args, **kwargs)
+            if validators is None:
+                return view_method(view, request, *args, **kwargs)
+
+            etag, last_modified = validators
+            response = get_conditional_response(
+                request, etag=etag,
+                last_modified=last_modified and int(last_modified.timestamp()))
+            if response is None:
+                response = view_method(view, request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+            return set_validators(response, etag, last_modified)
+        return wrapper
+    return decorator
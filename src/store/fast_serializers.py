@@ -0,0 +1,56 @@
+from store.serializers import BOOK_FIELD_VALUES, BooksSerializer
+from store.services.book import get_readers_preview_names
+
+BOOK_LIST_VALUES = tuple({value: None for field in BooksSerializer.Meta.fields
+                          for value in BOOK_FIELD_VALUES[field]})
+
+
+def get_book_list_values(books, fields=None):
+    """
+    Values of books needed by serialize_book_list for `fields`, all fields
+    by default, and by the keyset pagination for the queryset ordering
+    """
+    values = BOOK_LIST_VALUES
+    if fields is not None:
+        values = ['id', *{value: None for field in fields
+                          for value in BOOK_FIELD_VALUES[field]
+                          if value != 'id'}]
+    ordering = [field.lstrip('-') for field in books.query.order_by
+                if isinstance(field, str)]
+    return books.values(*values, *[
+        field for field in ordering if field not in values])
+
+
+def serialize_book_list(rows, fields=None):
+    """
+    Same data as BooksSerializer(many=True, fields=fields) built from
+    values() rows of books, without model instances and serializer field
+    machinery. Readers previews of all rows are loaded by one query,
+    only if they are requested
+    """
+    serializer_fields = BooksSerializer().fields
+    price_to_representation = serializer_fields['price'].to_representation
+    rating_to_representation = serializer_fields['rating'].to_representation
+    readers = {}
+    if fields is None or 'readers' in fields:
+        readers = get_readers_preview_names([row['id'] for row in rows])
+
+    getters = {
+        'id': lambda row: row['id'],
+        'name': lambda row: row['name'],
+        'price': lambda row: price_to_representation(row['price']),
+        'author_name': lambda row: row['author_name'],
+        'annotated_likes': lambda row: row['likes_count'],
+        'rating': lambda row: (None if row['rating'] is None
+                               else rating_to_representation(row['rating'])),
+        'owner_name': lambda row: ('' if row['owner_name'] is None
+                                   else row['owner_name']),
+        'readers_count': lambda row: row['readers_count'],
+        'readers': lambda row: [
+            {'first_name': first_name, 'last_name': last_name}
+            for first_name, last_name in readers.get(row['id'], ())],
+    }
+    if fields is not None:
+        getters = {field: getters[field] for field in fields}
+    getters = list(getters.items())
+    return [{field: getter(row) for field, getter in getters} for row in rows]
@@ -0,0 +1,138 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+logger = logging.getLogger('app.store.events')
+
+# fields of the current request added to every record logged during it
+log_context = ContextVar('log_context', default={})
+
+RECORD_FIELDS = ('name', 'levelname', 'message', 'exc_text', 'data')
+
+
+def is_sampled(sample_rate):
+    """Whether an event logged with `sample_rate` is kept this time"""
+    return sample_rate >= 1 or random.random() < sample_rate
+
+
+def log_event(event, sample_rate=1.0, **data):
+    """Log a structured event, only a `sample_rate` part of them"""
+    if not is_sampled(sample_rate):
+        return
+    logger.info(event, extra={'data': data})
+
+
+class ContextQueueHandler(QueueHandler):
+    """
+    Put records into the queue with the context of the current request.
+    Formatting is left to the writer thread, the request thread only
+    renders the message
+    """
+
+    def prepare(self, record):
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        record.context = log_context.get()
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        record.message = record.getMessage()
+        data = {'time': self.formatTime(record),
+                **getattr(record, 'context', {})}
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        return json.dumps(data, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        moment = super().formatTime(record, '%Y-%m-%dT%H:%M:%S')
+        return f'{moment}.{int(record.msecs):03d}'
+
+
+class JsonLinesFileHandler(RotatingFileHandler):
+    """Rotated file of records, flushed by the writer once per batch"""
+
+    def emit(self, record):
+        try:
+            if (self.stream is not None and self.maxBytes
+                    and self.stream.tell() >= self.maxBytes):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueLogWriter:
+    """
+    Thread writing records from the queue to the handler in batches every
+    `interval` seconds. It does not wake up for every record, so it rarely
+    takes the GIL from request threads
+    """
+    stop_record = None
+
+    def __init__(self, log_queue, handler, interval=0.1):
+        self.queue = log_queue
+        self.handler = handler
+        self.interval = interval
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='store-log-writer')
+        self.thread.start()
+
+    def run(self):
+        while self.write_batch():
+            time.sleep(self.interval)
+
+    def write_batch(self):
+        """Write all queued records, False if the writer is stopped"""
+        try:
+            while True:
+                record = self.queue.get_nowait()
+                if record is self.stop_record:
+                    return False
+                self.handler.handle(record)
+        except queue.Empty:
+            return True
+        finally:
+            self.handler.flush()
+
+    def stop(self):
+        """Write all queued records and stop the thread"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(self.stop_record)
+            self.thread.join()
+
+
+def get_queue_handler(filename, max_bytes=0, backup_count=0, interval=0.1):
+    """
+    Logging handler for settings.LOGGING: records are put into a queue on
+    the request path and written as rotated JSON lines by a thread
+    """
+    log_queue = queue.SimpleQueue()
+    file_handler = JsonLinesFileHandler(filename, maxBytes=max_bytes,
+                                        backupCount=backup_count, delay=True)
+    file_handler.setFormatter(JsonFormatter())
+    writer = QueueLogWriter(log_queue, file_handler, interval)
+    writer.start()
+    atexit.register(writer.stop)
+
+    handler = ContextQueueHandler(log_queue)
+    handler.writer = writer
+    return handler
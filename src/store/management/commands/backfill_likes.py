@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from store.services.book import backfill_likes
+
+
+class Command(BaseCommand):
+    help = 'Fill likes counters of books from user relations'
+
+    def handle(self, *args, **options):
+        books_count = backfill_likes()
+        self.stdout.write(self.style.SUCCESS(
+            f'Likes counters are filled for {books_count} books'))
@@ -0,0 +1,135 @@
+import json
+import statistics
+import time
+from contextlib import ExitStack
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from store.models import Book
+
+SCALES = {
+    '1k': {'users': 200, 'books': 1000, 'relations': 10000},
+    '100k': {'users': 10000, 'books': 100000, 'relations': 1000000},
+    '1m': {'users': 100000, 'books': 1000000, 'relations': 10000000},
+}
+
+
+class Command(BaseCommand):
+    help = ('Measure latency, throughput and query counts of the book '
+            'endpoints in process and write results as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=SCALES,
+                            help='Seed the library of this size first')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Requests per scenario')
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--scenario', action='append',
+                            help='Scenario to run, all by default')
+        parser.add_argument('--output', help='File to write, stdout by default')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        scenarios = self.get_scenarios()
+        names = options['scenario'] or list(scenarios)
+        unknown = set(names) - set(scenarios)
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(unknown)}')
+
+        if options['scale']:
+            call_command('seed_library', seed=options['seed'],
+                         stdout=self.stderr, **SCALES[options['scale']])
+        book = Book.objects.order_by('-readers_count', 'id').first()
+        user = User.objects.order_by('id').first()
+        if book is None or user is None:
+            raise CommandError('No books to benchmark, use --scale to seed')
+
+        client = Client(HTTP_HOST='127.0.0.1')
+        client.force_login(user)
+        context = {'book': book, 'user': user, 'client': client}
+        results = {
+            'scale': options['scale'],
+            'books': Book.objects.count(),
+            'requests': options['requests'],
+            'scenarios': {},
+        }
+        # responses are measured, not the response cache
+        with override_settings(STORE_RESPONSE_CACHE_TIMEOUT=0,
+                               STORE_QUERY_BUDGET_ACTION='log'):
+            for name in names:
+                self.stderr.write(f'Running {name}...')
+                results['scenarios'][name] = self.run_scenario(
+                    scenarios[name], context, options['requests'],
+                    options['warmup'])
+
+        output = json.dumps(results, indent=2)
+        if not options['output']:
+            self.stdout.write(output)
+            return
+        with open(options['output'], 'w') as file:
+            file.write(output)
+
+    @staticmethod
+    def get_scenarios():
+        def get(url):
+            return lambda context, i: context['client'].get(url(context))
+
+        def patch_relation(context, i):
+            return context['client'].patch(
+                f'/book_relation/{context["book"].id}/',
+                data=json.dumps({'rate': i % 5 + 1, 'like': bool(i % 2)}),
+                content_type='application/json')
+
+        return {
+            'list': get(lambda context: '/book/'),
+            'search': get(lambda context: '/book/?search=war'),
+            'ordering': get(lambda context: '/book/?ordering=-price'),
+            'filter': get(lambda context:
+                          f'/book/?price={context["book"].price}'),
+            'detail': get(lambda context: f'/book/{context["book"].id}/'),
+            'relation_patch': patch_relation,
+        }
+
+    @staticmethod
+    def run_scenario(scenario, context, requests_count, warmup):
+        for i in range(warmup):
+            scenario(context, i)
+
+        durations = []
+        queries = []
+        statuses = set()
+        started_at = time.perf_counter()
+        for i in range(requests_count):
+            # replica reads count as much as the primary ones
+            with ExitStack() as stack:
+                captured = [stack.enter_context(CaptureQueriesContext(
+                    connections[alias])) for alias in connections]
+                request_started_at = time.perf_counter()
+                response = scenario(context, i)
+                durations.append(time.perf_counter() - request_started_at)
+            queries.append(sum(len(capture) for capture in captured))
+            statuses.add(response.status_code)
+        elapsed = time.perf_counter() - started_at
+
+        durations.sort()
+
+        def percentile(value):
+            index = min(int(len(durations) * value), len(durations) - 1)
+            return round(durations[index] * 1000, 3)
+
+        return {
+            'requests_per_second': round(requests_count / elapsed, 1),
+            'mean_ms': round(statistics.mean(durations) * 1000, 3),
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(durations[-1] * 1000, 3),
+            'queries': max(queries),
+            'queries_mean': round(statistics.mean(queries), 2),
+            'statuses': sorted(statuses),
+        }
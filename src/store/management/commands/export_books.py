@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Book
+from store.services.export import WRITERS, export_books
+
+
+class Command(BaseCommand):
+    help = 'Export all books as JSON lines or CSV with constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=WRITERS, default='jsonl')
+        parser.add_argument('--output', help='File to write, stdout by default')
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Books fetched from db at once')
+
+    def handle(self, *args, **options):
+        lines = export_books(Book.objects.all(), options['format'],
+                             options['chunk_size'])
+        if not options['output']:
+            self.stdout.ending = ''
+            for line in lines:
+                self.stdout.write(line)
+            return
+        with open(options['output'], 'w', newline='') as file:
+            file.writelines(lines)
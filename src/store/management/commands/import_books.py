@@ -0,0 +1,142 @@
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from store.cache import invalidate_books
+from store.models import Book
+from store.serializers import BooksSerializer
+
+
+def read_csv(file):
+    yield from csv.DictReader(file)
+
+
+def read_jsonl(file):
+    for line in file:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # rejected by validation as not a dictionary
+            yield line.rstrip('\n')
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+class Command(BaseCommand):
+    help = 'Import books from CSV or JSON lines file with constant memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, "-" for stdin')
+        parser.add_argument('--format', choices=READERS,
+                            help='Input format, by default by file extension')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Books inserted in one transaction')
+        parser.add_argument('--upsert', action='store_true',
+                            help='Update price of existing books with the '
+                                 'same name and author_name')
+        parser.add_argument('--owner', help='Username of the books owner')
+        parser.add_argument('--rejects',
+                            help='JSON lines file for rejected rows')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['format'] or path.rsplit('.', 1)[-1]
+        if input_format not in READERS:
+            raise CommandError(f'Unknown format of {path}, use --format')
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size must be positive')
+        owner = None
+        if options['owner']:
+            try:
+                owner = User.objects.get(username=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError(f'User {options["owner"]} does not exist')
+
+        self.stats = {'rows': 0, 'created': 0, 'updated': 0, 'rejected': 0}
+        self.started_at = time.monotonic()
+        rejects = open(options['rejects'], 'w') if options['rejects'] else None
+        file = sys.stdin if path == '-' else open(path, newline='')
+        try:
+            rows = READERS[input_format](file)
+            while True:
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                books = self.validate(batch, owner, rejects)
+                with transaction.atomic():
+                    if options['upsert']:
+                        books = self.update_existing(books)
+                    Book.objects.bulk_create(books)
+                self.stats['created'] += len(books)
+                self.report()
+        finally:
+            if file is not sys.stdin:
+                file.close()
+            if rejects:
+                rejects.close()
+            invalidate_books()
+        self.report(self.style.SUCCESS)
+
+    def validate(self, rows, owner, rejects):
+        serializer = BooksSerializer()
+        books = []
+        for row in rows:
+            self.stats['rows'] += 1
+            try:
+                validated_data = serializer.run_validation(row)
+            except ValidationError as e:
+                self.stats['rejected'] += 1
+                if rejects:
+                    rejects.write(json.dumps({'row': self.stats['rows'],
+                                              'data': row,
+                                              'errors': e.detail}) + '\n')
+                continue
+            books.append(Book(owner=owner, **validated_data))
+        return books
+
+    def update_existing(self, books):
+        """
+        Update price of existing books, returns books to create. Rows
+        repeating a key of the batch count as updates, the last one wins
+        """
+        keys = {(book.name, book.author_name): book for book in books}
+        duplicates = len(books) - len(keys)
+        existing = Book.objects.filter(
+            name__in={name for name, _ in keys},
+            author_name__in={author_name for _, author_name in keys},
+        ).only('id', 'name', 'author_name', 'price')
+
+        updated_at = timezone.now()
+        to_update = []
+        for book in existing:
+            new_book = keys.pop((book.name, book.author_name), None)
+            if new_book is not None:
+                book.price = new_book.price
+                book.updated_at = updated_at
+                to_update.append(book)
+        Book.objects.bulk_update(to_update, ['price', 'updated_at'])
+        self.stats['updated'] += len(to_update) + duplicates
+        return list(keys.values())
+
+    def report(self, style=None):
+        elapsed = time.monotonic() - self.started_at
+        speed = self.stats['rows'] / elapsed if elapsed else 0
+        message = (f'{self.stats["rows"]} rows: {self.stats["created"]} '
+                   f'created, {self.stats["updated"]} updated, '
+                   f'{self.stats["rejected"]} rejected '
+                   f'in {elapsed:.1f}s ({speed:.0f} rows/s)')
+        self.stdout.write(style(message) if style else message)
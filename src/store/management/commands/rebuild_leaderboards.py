@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from store.services.leaderboard import rebuild_leaderboards
+
+
+class Command(BaseCommand):
+    help = ('Recompute leaderboards of all books and expire old activity, '
+            'run it hourly to keep the trending leaderboard fresh')
+
+    def handle(self, *args, **options):
+        rankings_count = rebuild_leaderboards()
+        self.stdout.write(self.style.SUCCESS(
+            f'Leaderboards are rebuilt with {rankings_count} rows'))
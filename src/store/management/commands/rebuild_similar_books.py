@@ -0,0 +1,57 @@
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from store.models import BookActivity
+from store.services.recommendations import TOP_K, rebuild_similar_books
+
+
+class Command(BaseCommand):
+    help = ('Recompute "readers also liked" books from likes and rates, '
+            'of all books or only of recently active ones')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=TOP_K,
+                            help='Similar books kept per book')
+        parser.add_argument('--book', type=int, action='append',
+                            dest='book_ids', help='Rebuild only this book')
+        parser.add_argument('--active-hours', type=int,
+                            help='Rebuild only books with activity '
+                                 'in the last hours')
+        parser.add_argument('--trace-memory', action='store_true',
+                            help='Rebuild once more with tracemalloc to '
+                                 'report peak memory, tracing slows it down')
+
+    def handle(self, *args, **options):
+        book_ids = options['book_ids']
+        if options['active_hours'] is not None:
+            since = timezone.now() - timedelta(hours=options['active_hours'])
+            book_ids = list(BookActivity.objects.filter(
+                hour__gte=since,
+            ).values_list('book', flat=True).distinct())
+
+        started = time.perf_counter()
+        sizes = rebuild_similar_books(book_ids, top_k=options['top_k'])
+        duration = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Similar books are rebuilt with {sizes["similar_books"]} rows '
+            f'for {sizes["books"]} books from {sizes["relations"]} relations '
+            f'in {duration:.1f}s, old rows are replaced in '
+            f'{sizes["swap_seconds"]:.1f}s'))
+        if not options['trace_memory']:
+            return
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            rebuild_similar_books(book_ids, top_k=options['top_k'])
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        duration = time.perf_counter() - started
+        self.stdout.write(
+            f'Traced rebuild: peak memory {peak / 2 ** 20:.1f} MiB '
+            f'in {duration:.1f}s')
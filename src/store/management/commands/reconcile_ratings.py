@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from store.services.book import reconcile_ratings, recompute_all_counters
+
+
+class Command(BaseCommand):
+    help = 'Check book rating counters against relations and fix wrong ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report books with wrong counters')
+        parser.add_argument('--counters', action='store_true',
+                            help='Recompute readers, likes and rating counters '
+                                 'of all books, e.g. after a crash in '
+                                 'write-behind mode')
+
+    def handle(self, *args, **options):
+        if options['counters']:
+            books_count = recompute_all_counters()
+            self.stdout.write(self.style.SUCCESS(
+                f'Counters are recomputed for {books_count} books'))
+            return
+        fix = not options['dry_run']
+        book_ids = reconcile_ratings(fix=fix)
+        if not book_ids:
+            self.stdout.write(self.style.SUCCESS('All rating counters are correct'))
+            return
+        action = 'Fixed' if fix else 'Found'
+        self.stdout.write(self.style.WARNING(
+            f'{action} wrong rating counters for {len(book_ids)} books: '
+            f'{", ".join(map(str, book_ids))}'))
@@ -0,0 +1,128 @@
+import random
+import time
+from bisect import bisect_left
+from itertools import accumulate
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from store.models import Book, UserBookRelation
+from store.services.book import (backfill_likes, backfill_readers,
+                                 reconcile_ratings)
+from store.services.leaderboard import rebuild_leaderboards
+
+FIRST_NAMES = ('Ivan', 'Anton', 'Maria', 'Olga', 'Petr', 'Anna', 'Sergey',
+               'Elena', 'Dmitry', 'Irina', 'Alexey', 'Natalia')
+LAST_NAMES = ('Ivanov', 'Petrov', 'Sidorov', 'Smirnov', 'Kuznetsov', 'Popov',
+              'Vasiliev', 'Sokolov', 'Mikhailov', 'Fedorov')
+WORDS = ('war', 'peace', 'night', 'river', 'garden', 'city', 'winter',
+         'house', 'road', 'sea', 'silence', 'fire', 'mountain', 'star',
+         'stranger', 'letters', 'secret', 'summer', 'island', 'shadow')
+
+
+class Command(BaseCommand):
+    help = ('Generate users, books and relations with skewed popularity: '
+            'a few best-sellers get most of the readers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--books', type=int, default=1000)
+        parser.add_argument('--relations', type=int, default=10000)
+        parser.add_argument('--skew', type=float, default=1.1,
+                            help='Zipf exponent of books popularity')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options['users'] <= 0 or options['books'] <= 0:
+            raise CommandError('--users and --books must be positive')
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        started_at = time.monotonic()
+
+        user_ids = self.create_users(options['users'])
+        book_ids = self.create_books(options['books'])
+        relations_count = self.create_relations(
+            user_ids, book_ids, options['relations'], options['skew'])
+        self.stdout.write('Updating book counters...')
+        backfill_readers()
+        backfill_likes()
+        reconcile_ratings()
+        rebuild_leaderboards()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(user_ids)} users, {len(book_ids)} books, '
+            f'{relations_count} relations '
+            f'in {time.monotonic() - started_at:.1f}s'))
+
+    def create_users(self, count):
+        last_id = User.objects.order_by('-id').values_list(
+            'id', flat=True).first() or 0
+        users = (User(username=f'reader{last_id + i}', password='!',
+                      first_name=self.random.choice(FIRST_NAMES),
+                      last_name=self.random.choice(LAST_NAMES))
+                 for i in range(1, count + 1))
+        self.bulk_create(User, users)
+        return list(User.objects.filter(id__gt=last_id).values_list(
+            'id', flat=True))
+
+    def create_books(self, count):
+        last_id = Book.objects.order_by('-id').values_list(
+            'id', flat=True).first() or 0
+        authors = [f'{self.random.choice(FIRST_NAMES)} '
+                   f'{self.random.choice(LAST_NAMES)}'
+                   for _ in range(max(count // 10, 1))]
+        books = (Book(name=' '.join(self.random.sample(WORDS, 3)).capitalize(),
+                      author_name=self.random.choice(authors),
+                      price=self.random.randrange(100, 500000) / 100)
+                 for _ in range(count))
+        self.bulk_create(Book, books)
+        return list(Book.objects.filter(id__gt=last_id).values_list(
+            'id', flat=True))
+
+    def create_relations(self, user_ids, book_ids, count, skew):
+        # books are shuffled, so ids of best-sellers are spread over the range
+        book_ids = self.random.sample(book_ids, len(book_ids))
+        cum_weights = list(accumulate(1 / (rank ** skew)
+                                      for rank in range(1, len(book_ids) + 1)))
+        mean = count / len(user_ids)
+        created = 0
+
+        def relations():
+            nonlocal created
+            for user_id in user_ids:
+                if created >= count:
+                    return
+                # heavy readers read much more books than the others
+                user_count = min(int(self.random.expovariate(1 / mean)) + 1,
+                                 count - created, len(book_ids))
+                books = set()
+                while len(books) < user_count:
+                    books.add(book_ids[bisect_left(
+                        cum_weights, self.random.random() * cum_weights[-1])])
+                for book_id in books:
+                    rate = self.random.choice((None, 3, 4, 4, 5, 5, 1, 2))
+                    yield UserBookRelation(
+                        user_id=user_id, book_id=book_id,
+                        like=self.random.random() < 0.3,
+                        in_bookmarks=self.random.random() < 0.1, rate=rate)
+                created += len(books)
+
+        self.bulk_create(UserBookRelation, relations())
+        return created
+
+    def bulk_create(self, model, objects):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                self.save_batch(model, batch)
+                batch = []
+        if batch:
+            self.save_batch(model, batch)
+
+    def save_batch(self, model, batch):
+        with transaction.atomic():
+            model.objects.bulk_create(batch)
+        self.stdout.write(f'{model.__name__}: +{len(batch)}')
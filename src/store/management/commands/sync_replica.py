@@ -0,0 +1,30 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = ('Copy the primary SQLite database into the local read replicas, '
+            'a development stand-in for replication')
+
+    def handle(self, *args, **options):
+        if not settings.STORE_READ_REPLICAS:
+            raise CommandError('No read replicas, set DJANGO_DB_REPLICA')
+        primary = connections[DEFAULT_DB_ALIAS]
+        aliases = [DEFAULT_DB_ALIAS, *settings.STORE_READ_REPLICAS]
+        if any(connections[alias].vendor != 'sqlite' for alias in aliases):
+            raise CommandError('Only SQLite databases can be copied')
+
+        primary.ensure_connection()
+        for alias in settings.STORE_READ_REPLICAS:
+            replica = connections[alias]
+            replica.close()
+            target = sqlite3.connect(replica.settings_dict['NAME'])
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
+            self.stdout.write(f'Copied into {alias}: '
+                              f'{replica.settings_dict["NAME"]}')
@@ -0,0 +1,97 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2)
+
+METRICS = {
+    'request_duration_seconds': DURATION_BUCKETS,
+    'sql_duration_seconds': DURATION_BUCKETS,
+    'render_duration_seconds': DURATION_BUCKETS,
+    'serialization_duration_seconds': DURATION_BUCKETS,
+    'sql_queries': QUERIES_BUCKETS,
+    'response_size_bytes': SIZE_BUCKETS,
+}
+
+
+@contextmanager
+def measure_serialization(request):
+    """
+    Add the time of the block to the serialization time of the request.
+    Views serialize data themselves, before the response is rendered,
+    by serializers or by the fast values() path
+    """
+    request = getattr(request, '_request', request)
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        request.serialization_duration = (
+            getattr(request, 'serialization_duration', 0)
+            + time.perf_counter() - started_at)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bucket}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Registry:
+    """In-process histograms of request metrics by view"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, view, **values):
+        with self.lock:
+            for metric, value in values.items():
+                key = (metric, view)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(METRICS[metric])
+                self.histograms[key].observe(value)
+
+    def get(self, metric, view):
+        return self.histograms.get((metric, view))
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for metric in METRICS:
+                name = f'store_{metric}'
+                lines.append(f'# TYPE {name} histogram')
+                for (histogram_metric, view), histogram in sorted(
+                        self.histograms.items()):
+                    if histogram_metric == metric:
+                        lines += histogram.render(name, f'view="{view}"')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
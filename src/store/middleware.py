@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+import uuid
+from contextvars import ContextVar
+
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+
+from store.log import log_context
+from store.metrics import registry
+from store.routers import use_primary
+
+logger = logging.getLogger('app.store')
+request_logger = logging.getLogger('app.store.requests')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started_at
+            self.count += 1
+
+
+# recorder of queries of the current request, in any thread running for it
+query_recorder = ContextVar('query_recorder', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = query_recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+def install_query_recorder(connection):
+    """Let queries of the connection be recorded for the current request"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class AsyncCapableMiddleware:
+    """
+    Base of middlewares working in sync and async chains. Under ASGI the
+    whole chain stays async, so an async view is awaited on the event loop
+    instead of holding the single thread of sync middlewares
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # Django awaits the middleware only if it looks like
+            # a coroutine function, as MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.async_call(request)
+        return self.sync_call(request)
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view_class = getattr(match.func, 'cls', None)
+    if view_class is None:
+        return match.func.__name__
+    actions = getattr(match.func, 'actions', None) or {}
+    action = actions.get(request.method.lower(), request.method.lower())
+    return f'{view_class.__name__}.{action}'
+
+
+class InstrumentationMiddleware(AsyncCapableMiddleware):
+    """
+    Record query count, SQL time, serialization and render time and
+    response size of every request into in-process histograms by view,
+    and check query budgets of views from STORE_QUERY_BUDGETS.
+    Budgets are for anonymous requests: authenticated ones also load
+    the session and the user, so they are not checked.
+    Queries are recorded on every connection by the context of the request,
+    so queries of views running in other threads are counted too
+    """
+
+    def sync_call(self, request):
+        recorder, token, started_at = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            query_recorder.reset(token)
+        return self.finish(request, response, recorder, started_at)
+
+    async def async_call(self, request):
+        recorder, token, started_at = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            query_recorder.reset(token)
+        return self.finish(request, response, recorder, started_at)
+
+    @staticmethod
+    def start(request):
+        request.render_duration = 0
+        request.serialization_duration = 0
+        recorder = QueryRecorder()
+        return recorder, query_recorder.set(recorder), time.perf_counter()
+
+    def finish(self, request, response, recorder, started_at):
+        duration = time.perf_counter() - started_at
+        view_name = get_view_name(request)
+        values = {
+            'request_duration_seconds': duration,
+            'sql_duration_seconds': recorder.duration,
+            'render_duration_seconds': request.render_duration,
+            'serialization_duration_seconds': request.serialization_duration,
+            'sql_queries': recorder.count,
+        }
+        if not response.streaming:
+            values['response_size_bytes'] = len(response.content)
+        registry.observe(view_name, **values)
+        if (settings.STORE_REQUEST_LOG
+                and request_logger.isEnabledFor(logging.INFO)):
+            self.log_request(request, response, view_name, values)
+        user = getattr(request, '_cached_user', None)
+        if user is None or not user.is_authenticated:
+            self.check_budget(view_name, recorder.count)
+        return response
+
+    @staticmethod
+    def log_request(request, response, view_name, values):
+        user = getattr(request, '_cached_user', None)
+        request_logger.info('request', extra={'data': {
+            'status': response.status_code,
+            # the user is not loaded only to be logged
+            'user': user.id if user is not None else None,
+            'duration_ms': round(values['request_duration_seconds'] * 1000,
+                                 3),
+            'sql_ms': round(values['sql_duration_seconds'] * 1000, 3),
+            'sql_queries': values['sql_queries'],
+        }})
+
+    def process_template_response(self, request, response):
+        started_at = time.perf_counter()
+
+        def set_render_duration(response):
+            request.render_duration = time.perf_counter() - started_at
+        response.add_post_render_callback(set_render_duration)
+        return response
+
+    def check_budget(self, view_name, queries):
+        budget = settings.STORE_QUERY_BUDGETS.get(view_name)
+        if budget is None or queries <= budget:
+            return
+        message = (f'{view_name} executed {queries} queries, '
+                   f'the budget is {budget}')
+        if settings.STORE_QUERY_BUDGET_ACTION == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+class LogContextMiddleware(AsyncCapableMiddleware):
+    """
+    Add the request id, method, path and view to records logged during
+    the request. The request id is taken from X-Request-ID if it is set
+    """
+
+    def sync_call(self, request):
+        token = log_context.set(self.get_context(request))
+        try:
+            return self.get_response(request)
+        finally:
+            log_context.reset(token)
+
+    async def async_call(self, request):
+        token = log_context.set(self.get_context(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            log_context.reset(token)
+
+    @staticmethod
+    def get_context(request):
+        return {
+            'request_id': (request.META.get('HTTP_X_REQUEST_ID')
+                           or uuid.uuid4().hex),
+            'method': request.method,
+            'path': request.path,
+        }
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        log_context.set({**log_context.get(),
+                         'view': get_view_name(request)})
+
+
+class ReplicaRoutingMiddleware(AsyncCapableMiddleware):
+    """
+    Let reads of safe requests go to the read replicas. A client who has
+    just written gets a cookie and reads from the primary database for
+    STORE_REPLICA_STICKY_SECONDS, so it sees its own writes despite
+    replication lag
+    """
+    cookie_name = 'store_primary'
+
+    def sync_call(self, request):
+        token = use_primary.set(self.needs_primary(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            use_primary.reset(token)
+        return self.set_cookie(request, response)
+
+    async def async_call(self, request):
+        token = use_primary.set(self.needs_primary(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            use_primary.reset(token)
+        return self.set_cookie(request, response)
+
+    def needs_primary(self, request):
+        return (request.method not in SAFE_METHODS
+                or self.cookie_name in request.COOKIES)
+
+    def set_cookie(self, request, response):
+        if (request.method not in SAFE_METHODS and settings.STORE_READ_REPLICAS
+                and response.status_code < 400):
+            response.set_cookie(self.cookie_name, '1', httponly=True,
+                                max_age=settings.STORE_REPLICA_STICKY_SECONDS)
+        return response
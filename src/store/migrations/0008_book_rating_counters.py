@@ -0,0 +1,38 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:03
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_rating_counters(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    books = Book.objects.annotate(
+        actual_rating_sum=Coalesce(Sum('userbookrelation__rate'), 0),
+        actual_rating_count=Count('userbookrelation__rate'),
+    )
+    for book in books.iterator():
+        book.rating_sum = book.actual_rating_sum
+        book.rating_count = book.actual_rating_count
+        book.save(update_fields=['rating_sum', 'rating_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_book_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_counters, migrations.RunPython.noop),
+    ]
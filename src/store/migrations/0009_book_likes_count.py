@@ -0,0 +1,30 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:03
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_likes_count(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    likes = UserBookRelation.objects.filter(
+        book=OuterRef('pk'), like=True,
+    ).order_by().values('book').annotate(count=Count('id')).values('count')
+    Book.objects.update(likes_count=Coalesce(Subquery(likes), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0008_book_rating_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_likes_count, migrations.RunPython.noop),
+    ]
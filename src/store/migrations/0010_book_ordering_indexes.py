@@ -0,0 +1,21 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_book_likes_count'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['price', 'id'], name='book_price_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['author_name', 'id'], name='book_author_name_id_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:05
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_readers_count(apps, schema_editor):
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    readers = UserBookRelation.objects.filter(
+        book=OuterRef('pk'),
+    ).order_by().values('book').annotate(count=Count('id')).values('count')
+    Book.objects.update(readers_count=Coalesce(Subquery(readers), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_book_ordering_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='readers_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(fields=['book', 'id'], name='relation_book_id_idx'),
+        ),
+        migrations.RunPython(fill_readers_count, migrations.RunPython.noop),
+    ]
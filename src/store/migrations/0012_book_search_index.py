@@ -0,0 +1,81 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+import store.models
+
+CREATE_FTS_SQL = [
+    """
+    CREATE VIRTUAL TABLE store_book_fts USING fts5(
+        name, author_name, content='store_book', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER store_book_fts_insert AFTER INSERT ON store_book BEGIN
+        INSERT INTO store_book_fts(rowid, name, author_name)
+        VALUES (new.id, new.name, new.author_name);
+    END
+    """,
+    """
+    CREATE TRIGGER store_book_fts_delete AFTER DELETE ON store_book BEGIN
+        INSERT INTO store_book_fts(store_book_fts, rowid, name, author_name)
+        VALUES ('delete', old.id, old.name, old.author_name);
+    END
+    """,
+    """
+    CREATE TRIGGER store_book_fts_update AFTER UPDATE OF name, author_name
+    ON store_book BEGIN
+        INSERT INTO store_book_fts(store_book_fts, rowid, name, author_name)
+        VALUES ('delete', old.id, old.name, old.author_name);
+        INSERT INTO store_book_fts(rowid, name, author_name)
+        VALUES (new.id, new.name, new.author_name);
+    END
+    """,
+    "INSERT INTO store_book_fts(store_book_fts) VALUES ('rebuild')",
+]
+
+DROP_FTS_SQL = [
+    'DROP TRIGGER IF EXISTS store_book_fts_insert',
+    'DROP TRIGGER IF EXISTS store_book_fts_delete',
+    'DROP TRIGGER IF EXISTS store_book_fts_update',
+    'DROP TABLE IF EXISTS store_book_fts',
+]
+
+
+def create_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in CREATE_FTS_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in DROP_FTS_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_book_readers_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSearchIndex',
+            fields=[
+                ('book', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index', serialize=False, to='store.book')),
+                ('name', models.TextField()),
+                ('author_name', models.TextField()),
+                ('document', store.models.FullTextField(db_column='store_book_fts')),
+                ('rank', models.FloatField()),
+            ],
+            options={
+                'db_table': 'store_book_fts',
+                'managed': False,
+            },
+        ),
+        migrations.RunPython(create_fts, drop_fts),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_book_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
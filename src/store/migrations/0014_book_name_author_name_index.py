@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0013_book_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['name', 'author_name'], name='book_name_author_name_idx'),
+        ),
+    ]
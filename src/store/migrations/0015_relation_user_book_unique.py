@@ -0,0 +1,48 @@
+from django.db import migrations, models
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import Coalesce
+
+
+def delete_duplicates(apps, schema_editor):
+    """Keep only the latest relation of every user with every book and
+    recount counters of the books whose duplicates were deleted"""
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    duplicates = UserBookRelation.objects.values('user', 'book').annotate(
+        last_id=Max('id'), count=Count('id'),
+    ).filter(count__gt=1).order_by()
+
+    book_ids = set()
+    for duplicate in duplicates:
+        UserBookRelation.objects.filter(
+            user_id=duplicate['user'], book_id=duplicate['book'],
+            id__lt=duplicate['last_id'],
+        ).delete()
+        book_ids.add(duplicate['book'])
+
+    for book_id in book_ids:
+        totals = UserBookRelation.objects.filter(book_id=book_id).aggregate(
+            readers_count=Count('id'),
+            likes_count=Count('id', filter=Q(like=True)),
+            rating_sum=Coalesce(Sum('rate'), 0),
+            rating_count=Count('rate'),
+        )
+        rating = None
+        if totals['rating_count']:
+            rating = totals['rating_sum'] / totals['rating_count']
+        Book.objects.filter(id=book_id).update(rating=rating, **totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_book_name_author_name_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userbookrelation',
+            constraint=models.UniqueConstraint(fields=('user', 'book'), name='relation_user_book_unique'),
+        ),
+    ]
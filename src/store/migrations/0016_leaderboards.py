@@ -0,0 +1,48 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0015_relation_user_book_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookRanking',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(choices=[('top_rated', 'Top rated'), ('most_liked', 'Most liked'), ('trending', 'Trending')], max_length=16)),
+                ('score', models.FloatField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='store.book')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BookActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity', to='store.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='bookranking',
+            index=models.Index(fields=['board', 'score', 'book'], name='ranking_board_score_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='bookranking',
+            constraint=models.UniqueConstraint(fields=('board', 'book'), name='ranking_board_book_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='bookactivity',
+            index=models.Index(fields=['hour'], name='activity_hour_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='bookactivity',
+            constraint=models.UniqueConstraint(fields=('book', 'hour'), name='activity_book_hour_unique'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.3 on 2026-10-18 04:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0016_leaderboards'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(fields=['user', 'in_bookmarks'], name='relation_user_bookmarks_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(fields=['user', 'like'], name='relation_user_like_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookrelation',
+            index=models.Index(fields=['user', 'rate'], name='relation_user_rate_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1.3 on 2026-10-18 05:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0017_relation_user_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarBook',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('book', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='similar_books', to='store.book')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='similarbook',
+            index=models.Index(fields=['book', 'score'], name='similar_book_score_idx'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.1.3 on 2026-10-18 05:07
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_histograms(apps, schema_editor):
+    """Count relations of every book with every rate in one UPDATE"""
+    Book = apps.get_model('store', 'Book')
+    UserBookRelation = apps.get_model('store', 'UserBookRelation')
+    relations = UserBookRelation.objects.filter(
+        book=OuterRef('pk'),
+    ).order_by().values('book')
+    Book.objects.filter(rating_count__gt=0).update(**{
+        f'rate_{rate}_count': Coalesce(Subquery(relations.filter(
+            rate=rate).annotate(count=Count('id')).values('count')), 0)
+        for rate in range(1, 6)
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0018_similar_books'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rate_1_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_2_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_3_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_4_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rate_5_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_histograms, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.3 on 2026-10-18 05:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_rating_histogram'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['author_name', 'price'], name='book_author_name_price_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.1.3 on 2026-10-18 05:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0020_book_author_name_price_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rate_1_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rate_2_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rate_3_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rate_4_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rate_5_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rating',
+            field=models.DecimalField(decimal_places=2, default=None, editable=False, max_digits=3, null=True),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='readers_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -1,8 +1,15 @@
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Lookup
+
+from store.log import log_event
 
 
 class Book(models.Model):
+    # counter of relations of the book with every rate
+    RATE_COUNT_FIELDS = {rate: f'rate_{rate}_count' for rate in range(1, 6)}
+
     name = models.CharField(max_length=255)
     price = models.DecimalField(max_digits=7, decimal_places=2)
     author_name = models.CharField(max_length=255)
@@ -11,12 +18,155 @@ class Book(models.Model):
 
     readers = models.ManyToManyField(User, through='UserBookRelation',
                                      related_name='books')
+    # counters are changed only by F() updates of relation writes
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=None,
-                                 null=True)
+                                 null=True, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rate_1_count = models.PositiveIntegerField(default=0, editable=False)
+    rate_2_count = models.PositiveIntegerField(default=0, editable=False)
+    rate_3_count = models.PositiveIntegerField(default=0, editable=False)
+    rate_4_count = models.PositiveIntegerField(default=0, editable=False)
+    rate_5_count = models.PositiveIntegerField(default=0, editable=False)
+    likes_count = models.PositiveIntegerField(default=0, editable=False)
+    readers_count = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['price', 'id'], name='book_price_id_idx'),
+            models.Index(fields=['author_name', 'id'],
+                         name='book_author_name_id_idx'),
+            models.Index(fields=['name', 'author_name'],
+                         name='book_name_author_name_idx'),
+            # covers counts of the author and price facets
+            models.Index(fields=['author_name', 'price'],
+                         name='book_author_name_price_idx'),
+        ]
 
     def __str__(self):
         return f'Id {self.id}: {self.name}'
 
+    def save(self, *args, **kwargs):
+        """
+        An edit of an existing book writes every field except the counters,
+        so counters changed by relation writes since the book was loaded
+        are not overwritten with the values it was loaded with
+        """
+        if (not self._state.adding and not args
+                and kwargs.get('update_fields') is None):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if field.editable and not field.primary_key
+            ] + ['updated_at']
+        super().save(*args, **kwargs)
+
+    @property
+    def rating_histogram(self):
+        """Number of relations of the book with every rate"""
+        return {rate: getattr(self, field)
+                for rate, field in self.RATE_COUNT_FIELDS.items()}
+
+
+class FullTextField(models.TextField):
+    """Hidden column of SQLite FTS5 table named after the table itself"""
+
+
+@FullTextField.register_lookup
+class Match(Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
+
+
+class BookSearchIndex(models.Model):
+    """
+    SQLite FTS5 index of book name and author name.
+    The table is created by migration only on SQLite and is kept in sync
+    with store_book by triggers
+    """
+    book = models.OneToOneField(Book, primary_key=True, db_column='rowid',
+                                on_delete=models.DO_NOTHING,
+                                related_name='search_index')
+    name = models.TextField()
+    author_name = models.TextField()
+    document = FullTextField(db_column='store_book_fts')
+    rank = models.FloatField()
+
+    class Meta:
+        managed = False
+        db_table = 'store_book_fts'
+
+
+class BookRanking(models.Model):
+    """
+    Precomputed position of the book in a leaderboard: leaderboards are
+    read by an index range scan over (board, score) without aggregation
+    """
+    TOP_RATED = 'top_rated'
+    MOST_LIKED = 'most_liked'
+    TRENDING = 'trending'
+    BOARD_CHOICES = (
+        (TOP_RATED, 'Top rated'),
+        (MOST_LIKED, 'Most liked'),
+        (TRENDING, 'Trending'),
+    )
+
+    board = models.CharField(max_length=16, choices=BOARD_CHOICES)
+    book = models.ForeignKey(Book, on_delete=models.CASCADE,
+                             related_name='rankings')
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['board', 'score', 'book'],
+                         name='ranking_board_score_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['board', 'book'],
+                                    name='ranking_board_book_unique'),
+        ]
+
+
+class BookActivity(models.Model):
+    """Number of relation changes of the book per hour, for trending"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE,
+                             related_name='activity')
+    hour = models.DateTimeField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'hour'],
+                                    name='activity_book_hour_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['hour'], name='activity_hour_idx'),
+        ]
+
+
+class SimilarBook(models.Model):
+    """
+    Precomputed nearest neighbor of the book by readers' likes and rates,
+    top-K neighbors per book
+    """
+    # served by the (book, score) index
+    book = models.ForeignKey(Book, on_delete=models.CASCADE,
+                             related_name='similar_books', db_index=False)
+    similar = models.ForeignKey(Book, on_delete=models.CASCADE,
+                                related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['book', 'score'],
+                         name='similar_book_score_idx'),
+        ]
+
+
 class UserBookRelation(models.Model):
     RATE_CHOICES = (
         (1, 'Ok'),
@@ -32,18 +182,65 @@ class UserBookRelation(models.Model):
     in_bookmarks = models.BooleanField(default=False)
     rate = models.PositiveSmallIntegerField(choices=RATE_CHOICES, null=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['book', 'id'], name='relation_book_id_idx'),
+            models.Index(fields=['user', 'in_bookmarks'],
+                         name='relation_user_bookmarks_idx'),
+            models.Index(fields=['user', 'like'],
+                         name='relation_user_like_idx'),
+            models.Index(fields=['user', 'rate'],
+                         name='relation_user_rate_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'book'],
+                                    name='relation_user_book_unique'),
+        ]
+
     def __str__(self):
         return f'User {self.user.username}, Book {self.book.name}, (rate {self.rate}*)'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def get_loaded_values(self, *field_names):
+        """Values of the fields as they are stored in db, without extra query
+        when the instance was loaded from db"""
+        loaded_values = getattr(self, '_loaded_values', {})
+        if all(field_name in loaded_values for field_name in field_names):
+            return {field_name: loaded_values[field_name]
+                    for field_name in field_names}
+        return UserBookRelation.objects.filter(id=self.id).values(
+            *field_names).first()
+
     def save(self, *args, **kwargs):
-        from store.services.book import set_rating
+        from store.services.book import update_counters
         is_creating = not self.pk
-        old_rating = None
+        old_values = {'like': False, 'rate': None}
         if not is_creating:
-            old_rating = UserBookRelation.objects.get(id=self.id).rate
-        super().save(*args, **kwargs)
+            old_values = self.get_loaded_values('like', 'rate')
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+            update_counters(self.book_id, readers_delta=int(is_creating),
+                            old_like=old_values['like'], new_like=self.like,
+                            old_rate=old_values['rate'], new_rate=self.rate)
+        self._loaded_values = {'like': self.like, 'rate': self.rate}
+
+        if old_values['rate'] != self.rate:
+            log_event('rating_changed',
+                      sample_rate=settings.STORE_RATING_EVENT_SAMPLE_RATE,
+                      book=self.book_id, user=self.user_id,
+                      old_rate=old_values['rate'], new_rate=self.rate)
 
-        new_rating = self.rate
-        if old_rating != new_rating or is_creating:
-            set_rating(self.book)
-            print(f'{self.book.name}: {old_rating}->>{new_rating} [{self.book.rating}]')
+    def delete(self, *args, **kwargs):
+        from store.services.book import update_counters
+        old_values = self.get_loaded_values('like', 'rate')
+        with transaction.atomic(savepoint=False):
+            result = super().delete(*args, **kwargs)
+            update_counters(self.book_id, readers_delta=-1,
+                            old_like=old_values['like'],
+                            old_rate=old_values['rate'])
+        return result
@@ -0,0 +1,159 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from functools import reduce
+from operator import and_, or_
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (seek) pagination by the current queryset ordering with `id` as
+    a tie-breaker. The cursor keeps ordering values of the edge row of the
+    page, so any page is an index range scan and deep pages cost the same
+    as the first one, unlike OFFSET.
+    Ordering fields must be not null.
+    """
+    cursor_query_param = 'cursor'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    tie_breaker = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(queryset)
+
+        cursor = self.decode_cursor(request)
+        reverse = False
+        if cursor is not None:
+            reverse, values = cursor
+            try:
+                queryset = queryset.filter(
+                    self.get_seek_filter(values, reverse))
+            except (ValueError, TypeError, ValidationError):
+                # values of a tampered cursor that do not fit the fields
+                raise NotFound(self.invalid_cursor_message)
+        ordering = self.ordering
+        if reverse:
+            ordering = [self.invert(field) for field in ordering]
+
+        results = list(queryset.order_by(*ordering)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, queryset):
+        ordering = [field for field in queryset.query.order_by
+                    if isinstance(field, str)]
+        if not ordering:
+            ordering = list(queryset.model._meta.ordering)
+        if self.tie_breaker not in [field.lstrip('-') for field in ordering]:
+            # same direction as the ordering, so one index scan serves both
+            descending = bool(ordering) and ordering[-1].startswith('-')
+            ordering.append(f'-{self.tie_breaker}' if descending
+                            else self.tie_breaker)
+        return ordering
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    def get_seek_filter(self, values, reverse):
+        """
+        Rows after the cursor in the ordering:
+        (f1 > v1) OR (f1 = v1 AND f2 > v2) OR ...
+        """
+        conditions = []
+        for index, field in enumerate(self.ordering):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') != reverse else 'gt'
+            equal = [Q(**{ordering_field.lstrip('-'): value})
+                     for ordering_field, value in zip(self.ordering[:index],
+                                                      values)]
+            conditions.append(
+                reduce(and_, equal, Q(**{f'{name}__{lookup}': values[index]})))
+        return reduce(or_, conditions)
+
+    @staticmethod
+    def get_value(item, field):
+        if isinstance(item, dict):
+            return item[field]
+        return getattr(item, field)
+
+    def get_link(self, item, reverse):
+        values = [self.get_value(item, field.lstrip('-'))
+                  for field in self.ordering]
+        return replace_query_param(self.base_url, self.cursor_query_param,
+                                   self.encode_cursor(values, reverse))
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.get_link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.get_link(self.page[0], reverse=True)
+
+    def encode_cursor(self, values, reverse):
+        data = json.dumps({'o': self.ordering, 'r': reverse, 'v': values},
+                          cls=DjangoJSONEncoder, separators=(',', ':'))
+        return urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            data = json.loads(urlsafe_b64decode(encoded.encode()).decode())
+            ordering, reverse, values = data['o'], bool(data['r']), data['v']
+            if ordering != self.ordering or len(values) != len(ordering):
+                raise ValueError('Cursor does not match the ordering')
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        return reverse, values
+
+
+class ReadersPagination(KeysetPagination):
+    page_size = 50
+    max_page_size = 500
+
+
+class LeaderboardPagination(KeysetPagination):
+    # book id of the ranking row, so the order matches the ranking index
+    tie_breaker = 'ranking_book'
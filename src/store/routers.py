@@ -0,0 +1,50 @@
+from contextvars import ContextVar
+from itertools import cycle
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+use_primary = ContextVar('use_primary', default=True)
+
+
+def reads_from_replicas():
+    """Whether reads of store models go to the read replicas now"""
+    return not use_primary.get() and bool(settings.STORE_READ_REPLICAS)
+
+
+class ReplicaRouter:
+    """
+    Reads of store models go to read replicas from STORE_READ_REPLICAS
+    in turn, unless the current request must see the primary database.
+    Outside of requests, e.g. in management commands, everything goes to
+    the primary database. Replicas are never written or migrated
+    """
+
+    def __init__(self):
+        self.replicas = ()
+        self.replicas_cycle = None
+
+    def get_replica(self):
+        replicas = tuple(settings.STORE_READ_REPLICAS)
+        if replicas != self.replicas:
+            self.replicas, self.replicas_cycle = replicas, cycle(replicas)
+        return next(self.replicas_cycle)
+
+    def db_for_read(self, model, **hints):
+        if not reads_from_replicas() or model._meta.app_label != 'store':
+            return DEFAULT_DB_ALIAS
+        return self.get_replica()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.STORE_READ_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in settings.STORE_READ_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,107 @@
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F
+from django.utils.module_loading import import_string
+from rest_framework.filters import SearchFilter
+
+
+class SQLiteFTSSearchBackend:
+    """
+    Search by SQLite FTS5 index of book name and author name.
+    Every term matches as a token prefix, results are ranked by bm25
+    """
+    token_re = re.compile(r'\w+')
+
+    def get_match_query(self, search_terms):
+        tokens = [token for term in search_terms
+                  for token in self.token_re.findall(term)]
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def search(self, queryset, search_terms):
+        match_query = self.get_match_query(search_terms)
+        if not match_query:
+            return queryset.none()
+        return queryset.filter(
+            search_index__document__match=match_query,
+        ).annotate(
+            search_rank=F('search_index__rank'),
+        ).order_by('search_rank', 'id')
+
+
+SQLITE_FTS_TRIGGERS = {
+    'store_book_fts_insert': """
+        CREATE TRIGGER IF NOT EXISTS store_book_fts_insert
+        AFTER INSERT ON store_book BEGIN
+            INSERT INTO store_book_fts(rowid, name, author_name)
+            VALUES (new.id, new.name, new.author_name);
+        END
+    """,
+    'store_book_fts_delete': """
+        CREATE TRIGGER IF NOT EXISTS store_book_fts_delete
+        AFTER DELETE ON store_book BEGIN
+            INSERT INTO store_book_fts(store_book_fts, rowid, name, author_name)
+            VALUES ('delete', old.id, old.name, old.author_name);
+        END
+    """,
+    'store_book_fts_update': """
+        CREATE TRIGGER IF NOT EXISTS store_book_fts_update
+        AFTER UPDATE OF name, author_name ON store_book BEGIN
+            INSERT INTO store_book_fts(store_book_fts, rowid, name, author_name)
+            VALUES ('delete', old.id, old.name, old.author_name);
+            INSERT INTO store_book_fts(rowid, name, author_name)
+            VALUES (new.id, new.name, new.author_name);
+        END
+    """,
+}
+
+
+def repair_sqlite_fts(using):
+    """
+    SQLite migrations which alter store_book remake the table and drop its
+    triggers. Recreate missing triggers and rebuild the index after migrate
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                       "AND name = 'store_book_fts'")
+        if cursor.fetchone() is None:
+            return
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' "
+                       "AND tbl_name = 'store_book'")
+        triggers = {row[0] for row in cursor.fetchall()}
+        if triggers.issuperset(SQLITE_FTS_TRIGGERS):
+            return
+        for sql in SQLITE_FTS_TRIGGERS.values():
+            cursor.execute(sql)
+        cursor.execute("INSERT INTO store_book_fts(store_book_fts) "
+                       "VALUES ('rebuild')")
+
+
+def get_search_backend(using):
+    """
+    Backend from STORE_SEARCH_BACKEND setting. By default full-text index is
+    used on SQLite, other databases use icontains lookups of SearchFilter
+    """
+    backend_path = getattr(settings, 'STORE_SEARCH_BACKEND', None)
+    if backend_path:
+        return import_string(backend_path)()
+    if connections[using].vendor == 'sqlite':
+        return SQLiteFTSSearchBackend()
+    return None
+
+
+class BookSearchFilter(SearchFilter):
+    """SearchFilter which uses the search backend when there is one"""
+
+    def filter_queryset(self, request, queryset, view):
+        backend = get_search_backend(queryset.db)
+        if backend is None:
+            return super().filter_queryset(request, queryset, view)
+        search_terms = self.get_search_terms(request)
+        if not search_terms:
+            return queryset
+        return backend.search(queryset, search_terms)
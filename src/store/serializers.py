@@ -1,7 +1,9 @@
 from django.contrib.auth.models import User
+from django.db import models
 from rest_framework import serializers
 from rest_framework.serializers import ModelSerializer
-from store.models import Book, UserBookRelation
+from store.models import Book, SimilarBook, UserBookRelation
+from store.services.book import get_readers_preview
 
 
 class BookReaderSerializer(ModelSerializer):
@@ -10,20 +12,129 @@ class BookReaderSerializer(ModelSerializer):
         fields = ('first_name', 'last_name')
 
 
+class BooksListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        books = list(data.all() if isinstance(data, models.Manager) else data)
+        if 'readers' in self.child.fields:
+            self.child.readers_preview = get_readers_preview(
+                [book.id for book in books])
+        return super().to_representation(books)
+
+
 class BooksSerializer(ModelSerializer):
-    annotated_likes = serializers.IntegerField(read_only=True)
+    annotated_likes = serializers.IntegerField(source='likes_count', read_only=True)
     rating = serializers.DecimalField(max_digits=3, decimal_places=2, read_only=True)
     owner_name = serializers.CharField(source='owner.username', default='', read_only=True)
 
-    readers = BookReaderSerializer(many=True, read_only=True)
+    readers_count = serializers.IntegerField(read_only=True)
+    readers = serializers.SerializerMethodField()
 
     class Meta:
         model = Book
-        fields = ['id', 'name', 'price', 'author_name',
-                  'annotated_likes', 'rating', 'owner_name', 'readers']
+        fields = ['id', 'name', 'price', 'author_name', 'annotated_likes',
+                  'rating', 'owner_name', 'readers_count', 'readers']
+        list_serializer_class = BooksListSerializer
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.readers_preview = None
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+    def get_readers(self, book):
+        readers_preview = self.readers_preview
+        if readers_preview is None:
+            readers_preview = get_readers_preview([book.id])
+        readers = readers_preview.get(book.id, [])
+        return BookReaderSerializer(readers, many=True).data
+
+
+class BookDetailSerializer(BooksSerializer):
+    rating_histogram = serializers.DictField(child=serializers.IntegerField(),
+                                             read_only=True)
+
+    class Meta(BooksSerializer.Meta):
+        fields = [*BooksSerializer.Meta.fields, 'rating_count',
+                  'rating_histogram']
+        read_only_fields = ['rating_count']
+
+
+# values of Book needed by every output field of the book serializers,
+# `owner_name` is the annotation of the owner username
+BOOK_FIELD_VALUES = {
+    'id': ('id',),
+    'name': ('name',),
+    'price': ('price',),
+    'author_name': ('author_name',),
+    'annotated_likes': ('likes_count',),
+    'rating': ('rating',),
+    'owner_name': ('owner_name',),
+    'readers_count': ('readers_count',),
+    'readers': ('id',),
+    'rating_count': ('rating_count',),
+    'rating_histogram': tuple(Book.RATE_COUNT_FIELDS.values()),
+}
+
+
+class BookReaderRelationSerializer(ModelSerializer):
+    first_name = serializers.CharField(source='user.first_name')
+    last_name = serializers.CharField(source='user.last_name')
+
+    class Meta:
+        model = UserBookRelation
+        fields = ('first_name', 'last_name')
 
 
 class UserBookRelationSerializer(ModelSerializer):
     class Meta:
         model = UserBookRelation
         fields = ('book', 'like', 'in_bookmarks', 'rate')
+
+
+class LibraryBookSerializer(ModelSerializer):
+    class Meta:
+        model = Book
+        fields = ('id', 'name', 'author_name', 'price', 'rating')
+
+
+class UserLibrarySerializer(ModelSerializer):
+    book = LibraryBookSerializer(read_only=True)
+
+    class Meta:
+        model = UserBookRelation
+        fields = ('book', 'like', 'in_bookmarks', 'rate')
+
+
+class SimilarBookSerializer(ModelSerializer):
+    book = LibraryBookSerializer(source='similar', read_only=True)
+
+    class Meta:
+        model = SimilarBook
+        fields = ('book', 'score')
+
+
+class UserBookRelationBulkListSerializer(serializers.ListSerializer):
+    max_length = 1000
+
+    def validate(self, attrs):
+        if len(attrs) > self.max_length:
+            raise serializers.ValidationError(
+                f'Ensure this field has no more than {self.max_length} elements.')
+        book_ids = {item['book_id'] for item in attrs}
+        existing_ids = set(Book.objects.filter(
+            id__in=book_ids).values_list('id', flat=True))
+        missing_ids = book_ids - existing_ids
+        if missing_ids:
+            raise serializers.ValidationError(
+                f'Invalid books: {", ".join(map(str, sorted(missing_ids)))}.')
+        return attrs
+
+
+class UserBookRelationBulkSerializer(ModelSerializer):
+    book = serializers.IntegerField(source='book_id')
+
+    class Meta:
+        model = UserBookRelation
+        fields = ('book', 'like', 'in_bookmarks', 'rate')
+        list_serializer_class = UserBookRelationBulkListSerializer
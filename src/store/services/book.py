@@ -1,9 +1,282 @@
-from django.db.models import Avg
+from collections import defaultdict
 
-from store.models import UserBookRelation
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import (Count, F, FloatField, OuterRef, Q, Subquery,
+                              Sum, Value, Window)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, Coalesce, NullIf, RowNumber
+from django.utils import timezone
+
+from store.cache import invalidate_books
+from store.models import Book, UserBookRelation
+from store.services.leaderboard import rankings_worker, refresh_rankings
+from store.writes import CoalescingWorker
+
+READERS_PREVIEW_SIZE = 5
+RATING_FIELDS = ['rating_sum', 'rating_count', 'rating',
+                 *Book.RATE_COUNT_FIELDS.values()]
+
+
+def get_rating(rating_sum, rating_count):
+    if not rating_count:
+        return None
+    return rating_sum / rating_count
+
+
+def set_histogram(book, histogram):
+    """
+    Set the rating histogram of the book from counts of relations with
+    every rate, and the rating sum, count and mean derived from it
+    """
+    for rate, field in Book.RATE_COUNT_FIELDS.items():
+        setattr(book, field, histogram.get(rate, 0))
+    book.rating_sum, book.rating_count = get_histogram_totals(histogram)
+    book.rating = get_rating(book.rating_sum, book.rating_count)
+
+
+def get_histogram_totals(histogram):
+    """
+    Rating sum and count of a histogram of counts of every rate,
+    the counts are numbers or expressions
+    """
+    rating_sum = sum(rate * count for rate, count in histogram.items())
+    return rating_sum, sum(histogram.values())
+
+
+def get_histogram_counters(histogram):
+    """
+    Rating histogram counters from expressions of counts of every rate,
+    with the rating sum, count and mean derived from them in the same
+    UPDATE, without aggregation over relations
+    """
+    rating_sum, rating_count = get_histogram_totals(histogram)
+    return {
+        **{Book.RATE_COUNT_FIELDS[rate]: count
+           for rate, count in histogram.items()},
+        'rating_sum': rating_sum,
+        'rating_count': rating_count,
+        'rating': Cast(rating_sum, FloatField()) / NullIf(
+            rating_count, Value(0), output_field=FloatField()),
+    }
 
 
 def set_rating(book):
-    rating = UserBookRelation.objects.filter(book=book).aggregate(rating=Avg('rate')).get('rating')
-    book.rating = rating
-    book.save()
+    """Recalculate rating counters of the book from all its relations"""
+    histogram = UserBookRelation.objects.filter(book=book).aggregate(**{
+        str(rate): Count('id', filter=Q(rate=rate))
+        for rate in Book.RATE_COUNT_FIELDS})
+    set_histogram(book, {int(rate): count
+                         for rate, count in histogram.items()})
+    book.save(update_fields=[*RATING_FIELDS, 'updated_at'])
+
+
+def update_counters(book_id, readers_delta=0, old_like=False, new_like=False,
+                    old_rate=None, new_rate=None):
+    """
+    Apply one relation change to the readers, likes and rating histogram
+    counters of the book.
+    Counters are changed in db with F() expressions, so concurrent changes
+    do not overwrite each other and no aggregate over relations is needed.
+    In write-behind mode the book is only queued for recompute on commit
+    """
+    queue_book_refresh(book_id)
+    if settings.STORE_COUNTERS_WRITE_BEHIND:
+        return
+
+    counters = {}
+    if readers_delta:
+        counters['readers_count'] = F('readers_count') + readers_delta
+
+    likes_delta = int(bool(new_like)) - int(bool(old_like))
+    if likes_delta:
+        counters['likes_count'] = F('likes_count') + likes_delta
+
+    if old_rate != new_rate:
+        histogram = {}
+        for rate, field in Book.RATE_COUNT_FIELDS.items():
+            rate_delta = int(rate == new_rate) - int(rate == old_rate)
+            histogram[rate] = F(field) + rate_delta if rate_delta else F(field)
+        counters.update(get_histogram_counters(histogram))
+
+    if counters:
+        Book.objects.filter(id=book_id).update(updated_at=timezone.now(),
+                                               **counters)
+
+
+def queue_book_refresh(book_id, using=None):
+    """
+    Queue the changed book for the background refresh of its leaderboards
+    after commit, and of its counters too in write-behind mode
+    """
+    worker = rankings_worker
+    if settings.STORE_COUNTERS_WRITE_BEHIND:
+        worker = counters_worker
+    transaction.on_commit(lambda: worker.add(book_id), using=using)
+
+
+def get_preview_relations(book_ids, size=READERS_PREVIEW_SIZE):
+    """
+    Relations of the first readers of every book, at most `size` per book.
+    Relations are numbered inside every book with a window function,
+    so only readers of the preview are loaded from db
+    """
+    ranked = UserBookRelation.objects.filter(book_id__in=book_ids).annotate(
+        reader_position=Window(RowNumber(), partition_by=[F('book_id')],
+                               order_by=F('id').asc()),
+    ).values('id', 'reader_position')
+    sql, params = ranked.query.sql_with_params()
+    return UserBookRelation.objects.filter(id__in=RawSQL(
+        f'SELECT ranked.id FROM ({sql}) ranked '
+        f'WHERE ranked.reader_position <= %s',
+        (*params, size),
+    )).order_by('book_id', 'id')
+
+
+def get_readers_preview(book_ids, size=READERS_PREVIEW_SIZE):
+    """First readers of every book as users"""
+    if not book_ids:
+        return {}
+    relations = get_preview_relations(book_ids, size).select_related(
+        'user').only('book', 'user', 'user__first_name', 'user__last_name')
+
+    readers = defaultdict(list)
+    for relation in relations:
+        readers[relation.book_id].append(relation.user)
+    return readers
+
+
+def get_readers_preview_names(book_ids, size=READERS_PREVIEW_SIZE):
+    """First readers of every book as (first_name, last_name) tuples"""
+    if not book_ids:
+        return {}
+    relations = get_preview_relations(book_ids, size).values_list(
+        'book_id', 'user__first_name', 'user__last_name')
+
+    readers = defaultdict(list)
+    for book_id, first_name, last_name in relations:
+        readers[book_id].append((first_name, last_name))
+    return readers
+
+
+def reconcile_ratings(fix=True):
+    """
+    Check rating counters and histograms of all books against the real
+    aggregate over relations. Returns ids of books with wrong counters,
+    fixes them if needed
+    """
+    books = Book.objects.annotate(
+        actual_rating_sum=Coalesce(Sum('userbookrelation__rate'), 0),
+        actual_rating_count=Count('userbookrelation__rate'),
+        **{f'actual_{field}': Count('userbookrelation', filter=Q(
+            userbookrelation__rate=rate))
+           for rate, field in Book.RATE_COUNT_FIELDS.items()},
+    ).exclude(
+        rating_sum=F('actual_rating_sum'),
+        rating_count=F('actual_rating_count'),
+        **{field: F(f'actual_{field}')
+           for field in Book.RATE_COUNT_FIELDS.values()},
+    ).order_by('id')
+
+    wrong_books = list(books)
+    if fix:
+        updated_at = timezone.now()
+        for book in wrong_books:
+            book.updated_at = updated_at
+            set_histogram(book, {
+                rate: getattr(book, f'actual_{field}')
+                for rate, field in Book.RATE_COUNT_FIELDS.items()})
+        Book.objects.bulk_update(wrong_books, [*RATING_FIELDS, 'updated_at'],
+                                 batch_size=500)
+        invalidate_books()
+    return [book.id for book in wrong_books]
+
+
+def backfill_likes():
+    """Fill likes counters of all books from relations in one statement"""
+    likes = UserBookRelation.objects.filter(
+        book=OuterRef('pk'), like=True,
+    ).order_by().values('book').annotate(count=Count('id')).values('count')
+    books_count = Book.objects.exclude(
+        likes_count=Coalesce(Subquery(likes), 0),
+    ).update(likes_count=Coalesce(Subquery(likes), 0),
+             updated_at=timezone.now())
+    invalidate_books()
+    return books_count
+
+
+def backfill_readers():
+    """Fill readers counters of all books from relations in one statement"""
+    readers = UserBookRelation.objects.filter(
+        book=OuterRef('pk'),
+    ).order_by().values('book').annotate(count=Count('id')).values('count')
+    books_count = Book.objects.exclude(
+        readers_count=Coalesce(Subquery(readers), 0),
+    ).update(readers_count=Coalesce(Subquery(readers), 0),
+             updated_at=timezone.now())
+    invalidate_books()
+    return books_count
+
+
+def recompute_counters(book_ids):
+    """
+    Recalculate readers, likes and rating histogram counters of the books
+    from their relations: one grouped pass over relations of the books and
+    one executemany UPDATE. The rating sum, count and mean are derived from
+    the histogram, so they are not aggregated separately
+    """
+    counts = {
+        'readers_count': Count('id'),
+        'likes_count': Count('id', filter=Q(like=True)),
+        **{field: Count('id', filter=Q(rate=rate))
+           for rate, field in Book.RATE_COUNT_FIELDS.items()},
+    }
+    books = {book_id: Book(id=book_id, **dict.fromkeys(counts, 0))
+             for book_id in book_ids}
+    for row in UserBookRelation.objects.filter(
+            book_id__in=books).order_by().values('book').annotate(**counts):
+        book = books[row.pop('book')]
+        for field, count in row.items():
+            setattr(book, field, count)
+    for book in books.values():
+        set_histogram(book, book.rating_histogram)
+
+    using = router.db_for_write(Book)
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    fields = ['readers_count', 'likes_count', *RATING_FIELDS]
+    sql = (
+        f'UPDATE {quote_name(Book._meta.db_table)} SET '
+        f'{", ".join(f"{quote_name(field)} = %s" for field in fields)}, '
+        f'{quote_name("updated_at")} = %s WHERE {quote_name("id")} = %s'
+    )
+    updated_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [
+            (*(getattr(book, field) for field in fields), updated_at, book.id)
+            for book in books.values()])
+    invalidate_books()
+
+
+def recompute_all_counters(batch_size=settings.STORE_COUNTERS_BATCH_SIZE):
+    """
+    Recalculate counters of all books in batches, the recovery of
+    write-behind counters lost with a crashed process. Returns the number
+    of books
+    """
+    book_ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(book_ids), batch_size):
+        recompute_counters(book_ids[start:start + batch_size])
+    return len(book_ids)
+
+
+def refresh_books(activity):
+    recompute_counters(activity)
+    refresh_rankings(activity)
+
+
+counters_worker = CoalescingWorker(
+    refresh_books,
+    max_staleness=settings.STORE_COUNTERS_MAX_STALENESS,
+    batch_size=settings.STORE_COUNTERS_BATCH_SIZE,
+)
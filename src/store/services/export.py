@@ -0,0 +1,55 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+
+EXPORT_FIELDS = ('id', 'name', 'price', 'author_name', 'annotated_likes',
+                 'rating', 'owner_name', 'readers_count')
+
+CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def iter_books(queryset, chunk_size=2000):
+    """Book rows of the queryset, fetched from db by chunks"""
+    rows = queryset.order_by('id').values(
+        'id', 'name', 'price', 'author_name', 'rating', 'readers_count',
+        annotated_likes=F('likes_count'), owner_name=F('owner__username'),
+    ).iterator(chunk_size=chunk_size)
+    for row in rows:
+        if row['owner_name'] is None:
+            row['owner_name'] = ''
+        yield {field: row[field] for field in EXPORT_FIELDS}
+
+
+def iter_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+class Echo:
+    """File-like object which returns what is written to it"""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow([row[field] for field in EXPORT_FIELDS])
+
+
+WRITERS = {
+    'jsonl': iter_jsonl,
+    'csv': iter_csv,
+}
+
+
+def export_books(queryset, output_format, chunk_size=2000):
+    """Lines of the export file in the format"""
+    return WRITERS[output_format](iter_books(queryset, chunk_size))
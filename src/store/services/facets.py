@@ -0,0 +1,51 @@
+from django.db.models import Count, Func, Q, Window
+
+
+def get_price_ranges(bounds):
+    """Price ranges [from, to) between sorted bounds, open at both ends"""
+    edges = [None, *bounds, None]
+    return list(zip(edges, edges[1:]))
+
+
+def get_price_filter(price_from, price_to):
+    price_filter = Q()
+    if price_from is not None:
+        price_filter &= Q(price__gte=price_from)
+    if price_to is not None:
+        price_filter &= Q(price__lt=price_to)
+    return price_filter
+
+
+class Total(Func):
+    """Sum of an aggregate over all groups of the query, as a window"""
+    function = 'SUM'
+    window_compatible = True
+
+
+def get_facets(books, price_bounds, authors_size):
+    """
+    Counts of the books by author and by price range in one query: books
+    are grouped by author, only `authors_size` authors with most books
+    are selected, and the total count and conditional counts of every
+    price range are summed over all authors by window functions
+    """
+    price_ranges = get_price_ranges(price_bounds)
+    rows = list(books.order_by().values('author_name').annotate(
+        count=Count('id'),
+        total=Window(Total(Count('id'))),
+        **{f'price_{index}': Window(Total(Count(
+            'id', filter=get_price_filter(*bounds))))
+           for index, bounds in enumerate(price_ranges)},
+    ).order_by('-count', 'author_name')[:max(authors_size, 1)])
+
+    total_row = rows[0] if rows else dict.fromkeys(
+        ['total', *(f'price_{index}' for index in range(len(price_ranges)))],
+        0)
+    return {
+        'count': total_row['total'],
+        'author_name': [{'value': row['author_name'], 'count': row['count']}
+                        for row in rows[:authors_size]],
+        'price': [{'from': price_from, 'to': price_to,
+                   'count': total_row[f'price_{index}']}
+                  for index, (price_from, price_to) in enumerate(price_ranges)],
+    }
@@ -0,0 +1,109 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from store.models import Book, BookActivity, BookRanking
+from store.writes import CoalescingWorker
+
+
+def get_hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def get_trending_start(now):
+    return get_hour(now - timedelta(hours=settings.STORE_TRENDING_HOURS - 1))
+
+
+def record_activity(activity, hour):
+    """Add numbers of relation changes of the books to their activity in
+    the hour, one upsert statement for all books"""
+    using = router.db_for_write(BookActivity)
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    table = quote_name(BookActivity._meta.db_table)
+    count = quote_name('count')
+    sql = (
+        f'INSERT INTO {table} '
+        f'({quote_name("book_id")}, {quote_name("hour")}, {count}) '
+        f'VALUES (%s, %s, %s) '
+        f'ON CONFLICT ({quote_name("book_id")}, {quote_name("hour")}) '
+        f'DO UPDATE SET {count} = {table}.{count} + excluded.{count}'
+    )
+    hour = connection.ops.adapt_datetimefield_value(hour)
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [(book_id, hour, events)
+                                 for book_id, events in activity.items()
+                                 if events])
+
+
+def get_rankings(books, trending_scores):
+    """Leaderboard rows of the books from values() rows of their counters"""
+    rankings = []
+    for book in books:
+        if (book['rating'] is not None and
+                book['rating_count'] >= settings.STORE_TOP_RATED_MIN_VOTES):
+            rankings.append(BookRanking(board=BookRanking.TOP_RATED,
+                                        book_id=book['id'],
+                                        score=float(book['rating'])))
+        if book['likes_count']:
+            rankings.append(BookRanking(board=BookRanking.MOST_LIKED,
+                                        book_id=book['id'],
+                                        score=book['likes_count']))
+        if trending_scores.get(book['id']):
+            rankings.append(BookRanking(board=BookRanking.TRENDING,
+                                        book_id=book['id'],
+                                        score=trending_scores[book['id']]))
+    return rankings
+
+
+def get_trending_scores(activity, now):
+    return dict(activity.filter(hour__gte=get_trending_start(now)).order_by(
+    ).values('book').annotate(score=Sum('count')).values_list('book', 'score'))
+
+
+BOOK_RANKING_VALUES = ('id', 'rating', 'rating_count', 'likes_count')
+
+
+def refresh_rankings(activity):
+    """
+    Record activity of the books and recompute their rows in all
+    leaderboards. `activity` maps book ids to numbers of their relation
+    changes since the last refresh
+    """
+    now = timezone.now()
+    book_ids = list(activity)
+    with transaction.atomic():
+        record_activity(activity, get_hour(now))
+        trending_scores = get_trending_scores(
+            BookActivity.objects.filter(book_id__in=book_ids), now)
+        books = Book.objects.filter(id__in=book_ids).values(
+            *BOOK_RANKING_VALUES)
+        BookRanking.objects.filter(book_id__in=book_ids).delete()
+        BookRanking.objects.bulk_create(get_rankings(books, trending_scores))
+
+
+def rebuild_leaderboards(batch_size=2000):
+    """
+    Recompute leaderboards of all books and delete activity older than
+    the trending window, so books without recent activity leave
+    the trending leaderboard
+    """
+    now = timezone.now()
+    BookActivity.objects.filter(hour__lt=get_trending_start(now)).delete()
+    with transaction.atomic():
+        trending_scores = get_trending_scores(BookActivity.objects.all(), now)
+        BookRanking.objects.all().delete()
+        books = Book.objects.order_by().values(*BOOK_RANKING_VALUES)
+        rankings = get_rankings(books.iterator(chunk_size=batch_size),
+                                trending_scores)
+        BookRanking.objects.bulk_create(rankings, batch_size=batch_size)
+    return len(rankings)
+
+
+rankings_worker = CoalescingWorker(
+    refresh_rankings,
+    max_staleness=settings.STORE_LEADERBOARD_MAX_STALENESS,
+)
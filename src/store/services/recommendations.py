@@ -0,0 +1,155 @@
+import time
+
+import numpy as np
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from scipy import sparse
+
+from store.models import SimilarBook, UserBookRelation
+
+RELATION_DTYPE = np.dtype([('user', np.int64), ('book', np.int64),
+                           ('like', np.bool_), ('rate', np.int8)])
+TOP_K = 20
+# bound of the similarity nonzeros computed at once, 12 bytes each
+MAX_BLOCK_NONZEROS = 20_000_000
+
+
+def load_relations(chunk_size=20000):
+    """Relations with a like or a good rate as a NumPy structured array"""
+    rows = UserBookRelation.objects.filter(
+        Q(like=True) | Q(rate__gte=3),
+    ).annotate(
+        rate_or_zero=Coalesce('rate', 0),
+    ).order_by().values_list('user_id', 'book_id', 'like', 'rate_or_zero')
+    return np.fromiter(rows.iterator(chunk_size=chunk_size),
+                       dtype=RELATION_DTYPE)
+
+
+def get_weights(relations):
+    """A like or a rate of 5 is the strongest signal, a rate of 3 is weak"""
+    rate_weights = np.clip((relations['rate'] - 2) / 3, 0, 1)
+    return np.maximum(relations['like'], rate_weights).astype(np.float32)
+
+
+def build_matrix(relations):
+    """
+    Sparse users x books matrix of weights with L2 normalized columns,
+    so products of its columns are cosine similarities of books.
+    Returns book ids of the columns and the CSC matrix
+    """
+    users, user_index = np.unique(relations['user'], return_inverse=True)
+    books, book_index = np.unique(relations['book'], return_inverse=True)
+    matrix = sparse.csc_matrix(
+        (get_weights(relations), (user_index, book_index)),
+        shape=(len(users), len(books)), dtype=np.float32)
+    norms = sparse.linalg.norm(matrix, axis=0)
+    return books, matrix @ sparse.diags(1 / norms, format='csc')
+
+
+def get_column_blocks(matrix, columns, max_nonzeros=MAX_BLOCK_NONZEROS):
+    """
+    Split columns into blocks whose similarity columns have at most
+    `max_nonzeros` nonzeros in total: a column of a best-seller
+    co-occurs with almost every book, a column of a rare book with few
+    """
+    binary = matrix.copy()
+    binary.data[:] = 1
+    user_degrees = np.asarray(binary.sum(axis=1)).ravel()
+    # every reader of the book adds at most its number of books
+    costs = binary.T @ user_degrees
+    block_ids = np.cumsum(costs[columns]) // max_nonzeros
+    return np.split(columns, np.flatnonzero(np.diff(block_ids)) + 1)
+
+
+def get_neighbors(matrix, columns, top_k=TOP_K):
+    """
+    Top-K most similar columns of the matrix for every one of `columns`,
+    as (column, neighbor columns, scores) sorted by score
+    """
+    similarity = (matrix.T @ matrix[:, columns]).tocsc()
+    for position, column in enumerate(columns):
+        start, end = similarity.indptr[position:position + 2]
+        rows = similarity.indices[start:end]
+        scores = similarity.data[start:end]
+        other = rows != column
+        rows, scores = rows[other], scores[other]
+        if len(scores) > top_k:
+            top = np.argpartition(-scores, top_k)[:top_k]
+            rows, scores = rows[top], scores[top]
+        order = np.lexsort((rows, -scores))
+        yield column, rows[order], scores[order]
+
+
+def get_similar_rows(books, matrix, columns, top_k=TOP_K):
+    """(book_id, similar_id, score) rows of the columns for the insert"""
+    book_ids, similar_ids, scores = [], [], []
+    for column, neighbors, neighbor_scores in get_neighbors(matrix, columns,
+                                                           top_k):
+        book_ids.append(np.full(len(neighbors), books[column]))
+        similar_ids.append(books[neighbors])
+        scores.append(neighbor_scores)
+    if not book_ids:
+        return []
+    # digits of float32 precision
+    scores = np.round(np.concatenate(scores).astype(np.float64), 6)
+    return list(zip(np.concatenate(book_ids).tolist(),
+                    np.concatenate(similar_ids).tolist(), scores.tolist()))
+
+
+def rebuild_similar_books(book_ids=None, top_k=TOP_K):
+    """
+    Recompute top-K similar books of all books, or only of `book_ids`,
+    from item-item cosine similarity of readers' likes and rates.
+    Rows are inserted with executemany of plain tuples, building
+    1M model instances would take longer than the whole similarity.
+    They are staged in a temporary table first, so the transaction
+    replacing old rows holds the write lock only for one INSERT ... SELECT.
+    Returns sizes of the build and seconds of the swap transaction
+    """
+    relations = load_relations()
+    books, matrix = build_matrix(relations)
+    columns = np.arange(len(books))
+    if book_ids is not None:
+        columns = np.flatnonzero(np.isin(books, list(book_ids)))
+
+    similar_books = SimilarBook.objects.all()
+    if book_ids is not None:
+        similar_books = similar_books.filter(book_id__in=book_ids)
+    using = router.db_for_write(SimilarBook)
+    quote_name = connections[using].ops.quote_name
+    table = quote_name(SimilarBook._meta.db_table)
+    staging = quote_name(f'{SimilarBook._meta.db_table}_staging')
+    columns_sql = (f'{quote_name("book_id")}, {quote_name("similar_id")}, '
+                   f'{quote_name("score")}')
+    rows_count = 0
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {staging}')
+        cursor.execute(f'CREATE TEMPORARY TABLE {staging} AS '
+                       f'SELECT {columns_sql} FROM {table} WHERE 1 = 0')
+        try:
+            for block in get_column_blocks(matrix, columns):
+                rows = get_similar_rows(books, matrix, block, top_k)
+                # writes of a temporary table do not lock the database
+                with transaction.atomic(using=using):
+                    cursor.executemany(
+                        f'INSERT INTO {staging} ({columns_sql}) '
+                        f'VALUES (%s, %s, %s)', rows)
+                rows_count += len(rows)
+
+            started = time.perf_counter()
+            with transaction.atomic(using=using):
+                similar_books.using(using).delete()
+                cursor.execute(f'INSERT INTO {table} ({columns_sql}) '
+                               f'SELECT {columns_sql} FROM {staging}')
+            swap_duration = time.perf_counter() - started
+        finally:
+            cursor.execute(f'DROP TABLE {staging}')
+    return {
+        'relations': len(relations),
+        'users': matrix.shape[0],
+        'books': len(columns),
+        'matrix_nonzeros': matrix.nnz,
+        'similar_books': rows_count,
+        'swap_seconds': swap_duration,
+    }
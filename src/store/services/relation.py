@@ -0,0 +1,165 @@
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import (Case, Exists, F, OuterRef, PositiveIntegerField,
+                              Value, When)
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from store.cache import invalidate_books
+from store.log import is_sampled, log_event
+from store.models import Book, UserBookRelation
+from store.services.book import (get_histogram_counters, queue_book_refresh,
+                                 recompute_counters, update_counters)
+
+RELATION_FIELDS = ('like', 'in_bookmarks', 'rate')
+
+
+def bulk_update_relations(user, items):
+    """
+    Upsert relations of the user with many books in one transaction.
+    Every item has `book_id` and any of like/in_bookmarks/rate, later items
+    for the same book win. Every book is changed by the same
+    INSERT ... ON CONFLICT upsert as a single relation, so concurrent
+    writes of the same relations neither conflict nor lose counters
+    """
+    changes = {}
+    for item in items:
+        changes.setdefault(item['book_id'], {}).update(
+            (field, value) for field, value in item.items()
+            if field in RELATION_FIELDS)
+
+    with transaction.atomic():
+        return [upsert_relation(user, book_id, fields)
+                for book_id, fields in changes.items()]
+
+
+def delete_relations(relations):
+    """
+    Delete relations of a queryset, e.g. by a bulk action of the admin,
+    and recompute counters of their books: QuerySet.delete() does not
+    call UserBookRelation.delete()
+    """
+    with transaction.atomic():
+        book_ids = set(relations.values_list('book_id', flat=True))
+        relations.delete()
+        refresh_counters(book_ids)
+
+
+def refresh_counters(book_ids):
+    """Recompute counters of the books after relations were bulk deleted"""
+    recompute_counters(book_ids)
+    for book_id in book_ids:
+        queue_book_refresh(book_id)
+
+
+def get_counters_update(user, fields):
+    """
+    Counters of the book changed by upsert of the relation of the user with
+    `fields`. Old values of the relation are read by subqueries inside
+    the same UPDATE, so the book row is read and changed in one statement
+    """
+    relation = UserBookRelation.objects.filter(user=user, book=OuterRef('pk'))
+
+    def old_flag(**filters):
+        return Case(When(Exists(relation.filter(**filters)), then=Value(1)),
+                    default=Value(0))
+
+    counters = {'readers_count': F('readers_count') + 1 - old_flag()}
+    if 'like' in fields:
+        counters['likes_count'] = (F('likes_count') + int(bool(fields['like']))
+                                   - old_flag(like=True))
+    if 'rate' in fields:
+        counters.update(get_histogram_counters(
+            get_rate_histogram(user, fields['rate'])))
+    return counters
+
+
+def get_rate_histogram(user, new_rate):
+    """
+    Counts of every rate of the book changed by the new rate of the user,
+    the rating sum, count and mean are derived from them.
+    The old rate is read by raw SQL subqueries: compiling five ORM
+    subqueries costs more than the whole UPDATE
+    """
+    quote_name = connections[router.db_for_write(Book)].ops.quote_name
+    old_rate = (
+        f'SELECT {quote_name("rate")} '
+        f'FROM {quote_name(UserBookRelation._meta.db_table)} '
+        f'WHERE {quote_name("user_id")} = %s AND {quote_name("book_id")} '
+        f'= {quote_name(Book._meta.db_table)}.{quote_name("id")}'
+    )
+    return {
+        rate: F(field) + int(rate == new_rate) - RawSQL(
+            f'CASE WHEN ({old_rate}) = %s THEN 1 ELSE 0 END', (user.id, rate),
+            output_field=PositiveIntegerField())
+        for rate, field in Book.RATE_COUNT_FIELDS.items()
+    }
+
+
+def upsert_relation(user, book_id, fields):
+    """
+    Create or update the relation of the user with the book by
+    INSERT ... SELECT ... ON CONFLICT, only `fields` of an existing relation
+    are changed. Counters of the book are updated first, so its row lock
+    serializes concurrent writers of the same book, or later by
+    the counters worker in write-behind mode.
+    The old rate is read under the same lock only for a sampled
+    `rating_changed` event, RETURNING sees the row after the change.
+    Raises Book.DoesNotExist if there is no such book
+    """
+    using = router.db_for_write(UserBookRelation)
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    meta = UserBookRelation._meta
+
+    values = {'like': False, 'in_bookmarks': False, 'rate': None, **fields}
+    columns = ['user_id', 'book_id', *RELATION_FIELDS]
+    changed = [field for field in RELATION_FIELDS if field in fields]
+    # DO NOTHING would return no row for an existing relation
+    assignments = ', '.join(
+        f'{quote_name(column)} = excluded.{quote_name(column)}'
+        for column in changed or ['user_id'])
+    # nothing is inserted for a missing book
+    sql = (
+        f'INSERT INTO {quote_name(meta.db_table)} '
+        f'({", ".join(quote_name(column) for column in columns)}) '
+        f'SELECT %s, {quote_name("id")}, '
+        f'{", ".join(["%s"] * len(RELATION_FIELDS))} '
+        f'FROM {quote_name(Book._meta.db_table)} '
+        f'WHERE {quote_name("id")} = %s '
+        f'ON CONFLICT ({quote_name("user_id")}, {quote_name("book_id")}) '
+        f'DO UPDATE SET {assignments} '
+        f'RETURNING {quote_name("id")}, '
+        f'{", ".join(quote_name(field) for field in RELATION_FIELDS)}'
+    )
+
+    write_behind = settings.STORE_COUNTERS_WRITE_BEHIND
+    # the sampling is decided first, so unsampled writes skip the old rate
+    log_rate = 'rate' in fields and is_sampled(
+        settings.STORE_RATING_EVENT_SAMPLE_RATE)
+    old_rate = None
+    with transaction.atomic(using=using, savepoint=False):
+        if not write_behind:
+            Book.objects.using(using).filter(id=book_id).update(
+                updated_at=timezone.now(), **get_counters_update(user, fields))
+        if log_rate:
+            old_rate = UserBookRelation.objects.using(using).filter(
+                user=user, book_id=book_id).values_list(
+                'rate', flat=True).first()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [user.id, *(values[field]
+                                            for field in RELATION_FIELDS),
+                                 book_id])
+            row = cursor.fetchone()
+    if row is None:
+        raise Book.DoesNotExist
+    queue_book_refresh(book_id, using=using)
+    if log_rate and old_rate != fields['rate']:
+        log_event('rating_changed', book=book_id, user=user.id, old_rate=old_rate,
+                  new_rate=fields['rate'])
+    invalidate_books()
+
+    relation = UserBookRelation.from_db(using, ['id', *RELATION_FIELDS], row)
+    relation.user = user
+    relation.book_id = book_id
+    return relation
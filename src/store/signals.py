@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from store.cache import invalidate_books
+from store.middleware import install_query_recorder
+from store.models import Book, UserBookRelation
+from store.services.relation import refresh_counters
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=UserBookRelation)
+@receiver(post_delete, sender=UserBookRelation)
+def invalidate_books_cache(sender, **kwargs):
+    invalidate_books()
+
+
+@receiver(pre_delete, sender=User)
+def remember_user_books(sender, instance, **kwargs):
+    # relations of the user are deleted by cascade, without their delete()
+    instance.relation_book_ids = set(UserBookRelation.objects.filter(
+        user=instance).values_list('book_id', flat=True))
+
+
+@receiver(post_delete, sender=User)
+def refresh_user_books(sender, instance, **kwargs):
+    refresh_counters(instance.relation_book_ids)
+
+
+@receiver(connection_created)
+def set_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in settings.STORE_SQLITE_PRAGMAS.items():
+        connection.connection.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(connection_created)
+def record_queries(sender, connection, **kwargs):
+    install_query_recorder(connection)
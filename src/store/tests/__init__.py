@@ -0,0 +1,9 @@
+import logging
+
+# tests must not write request logs into the project log file, whatever
+# runs them
+logger = logging.getLogger('app.store')
+for handler in logger.handlers:
+    if hasattr(handler, 'writer'):
+        handler.writer.stop()
+logger.handlers = [logging.NullHandler()]
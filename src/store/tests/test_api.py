@@ -1,14 +1,37 @@
+import asyncio
 import json
+import logging
+import os
+import queue
+import tempfile
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
 from django.contrib.auth.models import User
+from django.db import close_old_connections, connection, router
 from django.db.models import When, Case, Count, Avg
+from django.http import HttpResponse
+from django.test import (AsyncClient, RequestFactory, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.exceptions import ErrorDetail
 from rest_framework.test import APITestCase
 
+from store.cache import get_cache
+from store.fast_serializers import serialize_book_list
+from store.log import (ContextQueueHandler, get_queue_handler, log_context,
+                       log_event)
+from store.metrics import registry
+from store.middleware import QueryBudgetExceeded, ReplicaRoutingMiddleware
 from store.models import Book, UserBookRelation
 from store.serializers import BooksSerializer
+from store.services.book import reconcile_ratings
+from store.services.leaderboard import refresh_rankings
+from store.services.recommendations import rebuild_similar_books
 
 
 class BooksApiTestCase(APITestCase):
@@ -34,10 +57,61 @@ class BooksApiTestCase(APITestCase):
                 userbookrelation__like=True, then=1)))).order_by('id')
         serializer_data = BooksSerializer(books, many=True).data
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(serializer_data, response.data)
+        self.assertEqual(serializer_data, response.data['results'])
         self.assertEqual(serializer_data[0]['rating'], '5.00')
         self.assertEqual(serializer_data[0]['annotated_likes'], 1)
 
+    def test_get_sparse_fields(self):
+        url = reverse('book-list')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'fields': 'id,name,price',
+                                                  'ordering': '-price'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([
+            {'id': self.book_3.id, 'name': 'Test Book 3 Author1',
+             'price': '2000.00'},
+            {'id': self.book_2.id, 'name': 'Test Book 2', 'price': '1000.00'},
+            {'id': self.book_1.id, 'name': 'Test Book 1', 'price': '500.00'},
+        ], response.data['results'])
+        # only the page, no owner join and no readers preview
+        self.assertEqual(1, len(queries))
+        self.assertNotIn('auth_user', queries[0]['sql'])
+        self.assertNotIn('rating', queries[0]['sql'])
+
+        response = self.client.get(url, data={'omit': 'readers,owner_name',
+                                              'price': 2000})
+        self.assertEqual([{
+            'id': self.book_3.id, 'name': 'Test Book 3 Author1',
+            'price': '2000.00', 'author_name': 'Author3',
+            'annotated_likes': 0, 'rating': None, 'readers_count': 0,
+        }], response.data['results'])
+
+        response = self.client.get(url, data={'fields': 'name,owner'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_get_one_rating_histogram(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(1, response.data['rating_count'])
+        self.assertEqual({'1': 0, '2': 0, '3': 0, '4': 0, '5': 1},
+                         json.loads(response.content)['rating_histogram'])
+
+        response = self.client.get(url, data={'fields': 'rating_histogram'})
+        self.assertEqual(['rating_histogram'], list(response.data))
+        response = self.client.get(reverse('book-list'),
+                                   data={'fields': 'rating_histogram'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_get_one_sparse_fields(self):
+        url = reverse('book-detail', args=(self.book_3.id,))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, data={'fields': 'name,owner_name'})
+        self.assertEqual({'name': 'Test Book 3 Author1',
+                          'owner_name': 'test_username'}, response.data)
+        self.assertEqual(2, len(queries))
+        self.assertNotIn('price', queries[1]['sql'])
+
     def test_get_filter(self):
         url = reverse('book-list')
         response = self.client.get(url, data={'price': 1000})
@@ -47,7 +121,7 @@ class BooksApiTestCase(APITestCase):
 
         serializer_data = BooksSerializer(books, many=True).data
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, serializer_data)
+        self.assertEqual(response.data['results'], serializer_data)
 
     def test_get_search(self):
         url = reverse('book-list')
@@ -58,7 +132,7 @@ class BooksApiTestCase(APITestCase):
                 userbookrelation__like=True, then=1)))).order_by('id')
         serializer_data = BooksSerializer(books, many=True).data
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, serializer_data)
+        self.assertEqual(response.data['results'], serializer_data)
 
     def test_get_ordering_price(self):
         url = reverse('book-list')
@@ -68,7 +142,7 @@ class BooksApiTestCase(APITestCase):
                 userbookrelation__like=True, then=1)))).order_by('-price')
         serializer_data = BooksSerializer(books, many=True).data
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, serializer_data)
+        self.assertEqual(response.data['results'], serializer_data)
 
     def test_get_ordering_author_name(self):
         url = reverse('book-list')
@@ -78,7 +152,21 @@ class BooksApiTestCase(APITestCase):
                 userbookrelation__like=True, then=1)))).order_by('author_name')
         serializer_data = BooksSerializer(books, many=True).data
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, serializer_data)
+        self.assertEqual(response.data['results'], serializer_data)
+
+    def test_get_readers(self):
+        user2 = User.objects.create(username='test_username2', first_name='Ivan')
+        UserBookRelation.objects.create(user=user2, book=self.book_1)
+        url = reverse('book-readers', args=(self.book_1.id,))
+        response = self.client.get(url, data={'page_size': 1})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([{'first_name': '', 'last_name': ''}],
+                         response.data['results'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([{'first_name': 'Ivan', 'last_name': ''}],
+                         response.data['results'])
+        self.assertIsNone(response.data['next'])
 
     def test_create(self):
         self.assertEqual(3, Book.objects.all().count())
@@ -152,6 +240,809 @@ class BooksApiTestCase(APITestCase):
         self.assertEquals(2, Book.objects.all().count())
 
 
+class BooksPaginationApiTestCase(APITestCase):
+    def setUp(self):
+        self.books = [
+            Book.objects.create(name=f'Test Book {i}', price=price,
+                                author_name=f'Author{i % 2}')
+            for i, price in enumerate([500, 1000, 500, 2000, 1000])
+        ]
+
+    def get_ids(self, response):
+        return [book['id'] for book in response.data['results']]
+
+    def test_pages(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'page_size': 2})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([self.books[0].id, self.books[1].id],
+                         self.get_ids(response))
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([self.books[2].id, self.books[3].id],
+                         self.get_ids(response))
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([self.books[4].id], self.get_ids(response))
+        self.assertIsNone(response.data['next'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([self.books[2].id, self.books[3].id],
+                         self.get_ids(response))
+
+    def test_pages_ordering(self):
+        url = reverse('book-list')
+        ids = []
+        response = self.client.get(url, data={'page_size': 2,
+                                              'ordering': '-price'})
+        ids += self.get_ids(response)
+        while response.data['next']:
+            with self.assertNumQueries(2):
+                response = self.client.get(response.data['next'])
+            ids += self.get_ids(response)
+
+        expected_ids = list(Book.objects.order_by(
+            '-price', '-id').values_list('id', flat=True))
+        self.assertEqual(expected_ids, ids)
+
+    def test_pages_ordering_author_name(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'page_size': 3,
+                                              'ordering': 'author_name'})
+        response = self.client.get(response.data['next'])
+        expected_ids = list(Book.objects.order_by(
+            'author_name', 'id').values_list('id', flat=True))
+        self.assertEqual(expected_ids[3:], self.get_ids(response))
+
+    def test_cursor_of_other_ordering(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'page_size': 2})
+        cursor = response.data['next'].split('cursor=')[1]
+        response = self.client.get(url, data={'cursor': cursor,
+                                              'ordering': 'price'})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_invalid_cursor(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'cursor': 'wrong'})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_tampered_cursor(self):
+        url = reverse('book-list')
+        for ordering, values in [('id', ['abc']), ('id', [[1]]),
+                                 ('id', [{'id': 1}]), ('price', ['abc', 1])]:
+            response = self.client.get(url, data={'page_size': 2,
+                                                  'ordering': ordering})
+            query = parse_qs(urlparse(response.data['next']).query)
+            data = json.loads(urlsafe_b64decode(query['cursor'][0]))
+            data['v'] = values
+            cursor = urlsafe_b64encode(json.dumps(data).encode()).decode()
+            response = self.client.get(url, data={'cursor': cursor,
+                                                  'ordering': ordering})
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+            self.assertEqual('Invalid cursor', response.data['detail'])
+
+
+class BooksSearchApiTestCase(APITestCase):
+    def setUp(self):
+        self.book_1 = Book.objects.create(name='Tolstoy War and Peace',
+                                          price=500, author_name='Tolstoy')
+        self.book_2 = Book.objects.create(name='Anna Karenina', price=1000,
+                                          author_name='Tolstoy')
+        self.book_3 = Book.objects.create(name='Crime and Punishment',
+                                          price=700, author_name='Dostoevsky')
+
+    def search(self, **data):
+        response = self.client.get(reverse('book-list'), data=data)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        return [book['id'] for book in response.data['results']]
+
+    def test_prefix(self):
+        self.assertEqual([self.book_1.id], self.search(search='war pea'))
+        self.assertEqual([self.book_3.id], self.search(search='dostoev'))
+
+    def test_rank(self):
+        self.assertEqual([self.book_1.id, self.book_2.id],
+                         self.search(search='tolstoy'))
+        self.assertEqual([self.book_3.id, self.book_1.id],
+                         self.search(search='and', ordering='-price'))
+
+    def test_pages(self):
+        ids = self.search(search='tolstoy', page_size=1)
+        response = self.client.get(reverse('book-list'),
+                                   data={'search': 'tolstoy', 'page_size': 1})
+        response = self.client.get(response.data['next'])
+        ids += [book['id'] for book in response.data['results']]
+        self.assertEqual([self.book_1.id, self.book_2.id], ids)
+
+    def test_index_sync(self):
+        self.book_2.name = 'Resurrection'
+        self.book_2.save()
+        self.assertEqual([], self.search(search='anna'))
+        self.assertEqual([self.book_2.id], self.search(search='resurrect'))
+
+        self.book_3.delete()
+        self.assertEqual([], self.search(search='crime'))
+
+    def test_no_tokens(self):
+        self.assertEqual([], self.search(search='"*'))
+
+
+class BooksCacheApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(name='Test Book 1', price=500,
+                                          author_name='Author1')
+
+    def test_cached(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'price': 500, 'ordering': 'price'})
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(
+                url, data={'ordering': 'price', 'price': 500})
+        self.assertEqual(response.data, cached_response.data)
+
+        url = reverse('book-detail', args=(self.book_1.id,))
+        response = self.client.get(url)
+        with self.assertNumQueries(1):
+            cached_response = self.client.get(url)
+        self.assertEqual(response.data, cached_response.data)
+
+    @override_settings(STORE_READ_REPLICAS=['default'],
+                       STORE_REPLICA_STICKY_SECONDS=5)
+    def test_replica_cached_apart(self):
+        url = reverse('book-list')
+        with mock.patch.object(get_cache(), 'set',
+                               wraps=get_cache().set) as cache_set:
+            response = self.client.get(url)
+        self.assertEqual(5, cache_set.call_args.kwargs['timeout'])
+        self.assertNotIn('ETag', response)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        # clients sticky to the primary database never read replica data
+        self.client.cookies[ReplicaRoutingMiddleware.cookie_name] = '1'
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertIn('ETag', response)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+    def test_invalidate_relation(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        self.client.get(url)
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=4)
+        response = self.client.get(url)
+        self.assertEqual(1, response.data['annotated_likes'])
+        self.assertEqual('4.00', response.data['rating'])
+
+    def test_invalidate_rating(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        Book.objects.filter(id=self.book_1.id).update(rating_sum=5,
+                                                      rating_count=1)
+        self.client.get(url)
+        reconcile_ratings()
+        response = self.client.get(url)
+        self.assertIsNone(response.data['rating'])
+
+    def test_invalidate_book(self):
+        url = reverse('book-list')
+        self.client.get(url)
+        Book.objects.create(name='Test Book 2', price=1000,
+                            author_name='Author2')
+        response = self.client.get(url)
+        self.assertEqual(2, len(response.data['results']))
+
+    def test_stats(self):
+        url = reverse('book-cache-stats')
+        self.client.force_login(self.user)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(url)
+        hits = response.data['hits']
+        misses = response.data['misses']
+        self.client.get(reverse('book-list'), data={'search': 'stats'})
+        self.client.get(reverse('book-list'), data={'search': 'stats'})
+        response = self.client.get(url)
+        self.assertEqual(hits + 1, response.data['hits'])
+        self.assertEqual(misses + 1, response.data['misses'])
+
+
+class BooksConditionalApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(name='Test Book 1', price=500,
+                                          author_name='Author1')
+        self.book_2 = Book.objects.create(name='Test Book 2', price=1000,
+                                          author_name='Author2')
+
+    def test_detail_etag(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_detail_etag_same_second(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        user_2 = User.objects.create(username='test_username2')
+        relation = UserBookRelation.objects.create(user=self.user,
+                                                   book=self.book_1, like=True)
+        etag = self.client.get(url)['ETag']
+
+        UserBookRelation.objects.create(user=user_2, book=self.book_1,
+                                        like=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(2, response.data['annotated_likes'])
+
+        etag = response['ETag']
+        relation.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(1, response.data['annotated_likes'])
+
+    def test_detail_if_modified_since(self):
+        url = reverse('book-detail', args=(self.book_1.id,))
+        response = self.client.get(url)
+        response = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+    def test_list_etag(self):
+        url = reverse('book-list')
+        response = self.client.get(url, data={'price': 500})
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, data={'price': 500},
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        response = self.client.get(url, data={'price': 1000},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        # any write of books changes the version
+        UserBookRelation.objects.create(user=self.user, book=self.book_2,
+                                        like=True)
+        response = self.client.get(url, data={'price': 500},
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+    def test_not_found(self):
+        url = reverse('book-detail', args=(100,))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"etag"')
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class BooksExportApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(name='Test Book 1', price=500,
+                                          author_name='Author1',
+                                          owner=self.user)
+        self.book_2 = Book.objects.create(name='Test Book, 2', price=1000,
+                                          author_name='Author2')
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=5)
+
+    def get_content(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_jsonl(self):
+        url = reverse('book-export')
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        rows = [json.loads(line)
+                for line in self.get_content(response).splitlines()]
+        self.assertEqual([
+            {'id': self.book_1.id, 'name': 'Test Book 1', 'price': '500.00',
+             'author_name': 'Author1', 'annotated_likes': 1, 'rating': '5.00',
+             'owner_name': 'test_username', 'readers_count': 1},
+            {'id': self.book_2.id, 'name': 'Test Book, 2', 'price': '1000.00',
+             'author_name': 'Author2', 'annotated_likes': 0, 'rating': None,
+             'owner_name': '', 'readers_count': 0},
+        ], rows)
+
+    def test_csv_filter(self):
+        url = reverse('book-export')
+        response = self.client.get(url, data={'output': 'csv', 'price': 1000})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(
+            'id,name,price,author_name,annotated_likes,rating,owner_name,'
+            'readers_count\r\n'
+            f'{self.book_2.id},"Test Book, 2",1000.00,Author2,0,,,0\r\n',
+            self.get_content(response))
+
+    def test_wrong_output(self):
+        url = reverse('book-export')
+        response = self.client.get(url, data={'output': 'xml'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+
+@override_settings(STORE_ASYNC_THREAD_SENSITIVE=True)
+class AsyncBooksApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.book_1 = Book.objects.create(name='Test Book 1', price=500,
+                                          author_name='Author1')
+        self.book_2 = Book.objects.create(name='Test Book 2', price=1000,
+                                          author_name='Author2')
+
+    def test_get(self):
+        response = self.client.get('/async/book/', data={'ordering': '-price'})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        expected = self.client.get(reverse('book-list'),
+                                   data={'ordering': '-price'})
+        self.assertEqual(expected.json()['results'],
+                         response.json()['results'])
+
+    def test_get_detail(self):
+        response = self.client.get(f'/async/book/{self.book_1.id}/')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('Test Book 1', response.json()['name'])
+
+        response = self.client.get('/async/book/100/')
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_relation(self):
+        url = f'/async/book_relation/{self.book_1.id}/'
+        response = self.client.patch(url, data=json.dumps({'like': True}),
+                                     content_type='application/json')
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+        self.client.force_login(self.user)
+        response = self.client.patch(url, data=json.dumps({'like': True}),
+                                     content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        relation = UserBookRelation.objects.get(user=self.user,
+                                                book=self.book_1)
+        self.assertTrue(relation.like)
+
+
+@override_settings(STORE_RESPONSE_CACHE_TIMEOUT=0,
+                   STORE_QUERY_BUDGET_ACTION='raise')
+class AsyncThreadPoolApiTestCase(TransactionTestCase):
+    def setUp(self):
+        registry.clear()
+        for i in range(3):
+            Book.objects.create(name=f'Test Book {i}', price=500,
+                                author_name='Author1')
+
+    async def test_get(self):
+        with mock.patch('store.async_views.close_old_connections',
+                        wraps=close_old_connections) as close:
+            response = await AsyncClient().get('/async/book/')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(3, len(response.json()['results']))
+        # connections of pool threads are closed by the view itself
+        close.assert_called_once_with()
+        # queries of the pool thread are counted for the request
+        self.assertEqual(
+            2, registry.get('sql_queries', 'BookViewSet.list').sum)
+
+    async def test_concurrent(self):
+        def slow_serialize(*args, **kwargs):
+            time.sleep(0.3)
+            return serialize_book_list(*args, **kwargs)
+
+        client = AsyncClient()
+        with mock.patch('store.views.serialize_book_list', slow_serialize):
+            started_at = time.perf_counter()
+            responses = await asyncio.gather(*(
+                client.get('/async/book/') for _ in range(5)))
+            duration = time.perf_counter() - started_at
+        self.assertEqual({status.HTTP_200_OK},
+                         {response.status_code for response in responses})
+        # one after another they would take 1.5s
+        self.assertLess(duration, 1)
+
+
+@override_settings(STORE_QUERY_BUDGET_ACTION='raise')
+class InstrumentationApiTestCase(APITestCase):
+    def setUp(self):
+        registry.clear()
+        self.user = User.objects.create(username='test_username')
+        for i in range(3):
+            book = Book.objects.create(name=f'Test Book {i}', price=500,
+                                       author_name='Author')
+            UserBookRelation.objects.create(user=self.user, book=book,
+                                            like=True)
+
+    def test_budgets(self):
+        response = self.client.get(reverse('book-list'))
+        book_id = response.data['results'][0]['id']
+        self.client.get(reverse('book-list'), data={'search': 'book'})
+        self.client.get(reverse('book-detail', args=(book_id,)))
+        self.client.get(reverse('book-readers', args=(book_id,)))
+
+        histogram = registry.get('sql_queries', 'BookViewSet.list')
+        self.assertEqual(2, histogram.count)
+        self.assertEqual(4, histogram.sum)
+
+    @override_settings(STORE_QUERY_BUDGETS={'BookViewSet.list': 1})
+    def test_budget_exceeded(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse('book-list'))
+
+    @override_settings(STORE_QUERY_BUDGET_ACTION='raise')
+    def test_budget_authenticated(self):
+        self.client.force_login(self.user)
+        for url in (reverse('book-list'),
+                    reverse('book-detail', args=(Book.objects.first().id,))):
+            response = self.client.get(url)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+        # session and user queries are over the anonymous budget
+        self.assertEqual(4, registry.get('sql_queries',
+                                         'BookViewSet.list').sum)
+
+    def test_serialization_duration(self):
+        self.client.get(reverse('book-list'))
+        histogram = registry.get('serialization_duration_seconds',
+                                 'BookViewSet.list')
+        self.assertEqual(1, histogram.count)
+        self.assertGreater(histogram.sum, 0)
+
+    def test_metrics(self):
+        self.client.get(reverse('book-list'))
+        response = self.client.get('/metrics/')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        content = response.content.decode()
+        self.assertIn('store_sql_queries_count{view="BookViewSet.list"} 1',
+                      content)
+        self.assertIn('store_response_size_bytes_bucket'
+                      '{view="BookViewSet.list",le="+Inf"} 1', content)
+        self.assertIn('store_books_cache_misses_total', content)
+
+    def test_metrics_forbidden(self):
+        response = self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+
+class BooksFacetsApiTestCase(APITestCase):
+    def setUp(self):
+        for name, price, author_name in (('Test Book 1', 300, 'Author1'),
+                                         ('Test Book 2', 500, 'Author1'),
+                                         ('Test Book 3', 2500, 'Author2'),
+                                         ('Other Book', 1500, 'Author1')):
+            Book.objects.create(name=name, price=price,
+                                author_name=author_name)
+
+    def test_get(self):
+        url = reverse('book-facets')
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({
+            'count': 4,
+            'author_name': [{'value': 'Author1', 'count': 3},
+                            {'value': 'Author2', 'count': 1}],
+            'price': [{'from': None, 'to': '500.00', 'count': 1},
+                      {'from': '500.00', 'to': '1000.00', 'count': 1},
+                      {'from': '1000.00', 'to': '2000.00', 'count': 1},
+                      {'from': '2000.00', 'to': None, 'count': 1}],
+        }, response.data)
+
+    @override_settings(STORE_AUTHOR_FACET_SIZE=1)
+    def test_authors_size(self):
+        url = reverse('book-facets')
+        response = self.client.get(url)
+        self.assertEqual(4, response.data['count'])
+        self.assertEqual([{'value': 'Author1', 'count': 3}],
+                         response.data['author_name'])
+        self.assertEqual([1, 1, 1, 1], [price_range['count'] for price_range
+                                        in response.data['price']])
+
+        response = self.client.get(url, data={'price': 700})
+        self.assertEqual(0, response.data['count'])
+        self.assertEqual([], response.data['author_name'])
+        self.assertEqual([0, 0, 0, 0], [price_range['count'] for price_range
+                                        in response.data['price']])
+
+    def test_get_filter_and_search(self):
+        url = reverse('book-facets')
+        response = self.client.get(url, data={'facets': 'author_name',
+                                              'search': 'Test'})
+        self.assertEqual({
+            'count': 3,
+            'author_name': [{'value': 'Author1', 'count': 2},
+                            {'value': 'Author2', 'count': 1}],
+        }, response.data)
+
+        response = self.client.get(url, data={'facets': 'price,author_name',
+                                              'price': 500})
+        self.assertEqual(1, response.data['count'])
+        self.assertEqual([0, 1, 0, 0], [price_range['count'] for price_range
+                                        in response.data['price']])
+
+        response = self.client.get(url, data={'facets': 'rating'})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_cached(self):
+        url = reverse('book-facets')
+        self.client.get(url, data={'search': 'Test', 'facets': 'price'})
+        with self.assertNumQueries(0):
+            response = self.client.get(url, data={'ordering': '-price',
+                                                  'search': 'Test'})
+        self.assertEqual(3, response.data['count'])
+
+        Book.objects.create(name='Test Book 4', price=100,
+                            author_name='Author3')
+        response = self.client.get(url, data={'search': 'Test'})
+        self.assertEqual(4, response.data['count'])
+
+
+class BooksLeaderboardApiTestCase(APITestCase):
+    def setUp(self):
+        users = [User.objects.create(username=f'test_username{i}')
+                 for i in range(3)]
+        self.books = [Book.objects.create(name=f'Test Book {i}', price=500,
+                                          author_name='Author1')
+                      for i in range(3)]
+        for book, likes in zip(self.books, (1, 3, 2)):
+            for user in users[:likes]:
+                UserBookRelation.objects.create(user=user, book=book,
+                                                like=True)
+        refresh_rankings({book.id: 1 for book in self.books})
+
+    def test_most_liked(self):
+        url = reverse('book-leaderboard', args=('most_liked',))
+        with self.assertNumQueries(2):
+            response = self.client.get(url, data={'page_size': 2})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([(self.books[1].id, 3), (self.books[2].id, 2)],
+                         [(book['id'], book['score'])
+                          for book in response.data['results']])
+        self.assertEqual(3, response.data['results'][0]['annotated_likes'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([(self.books[0].id, 1)],
+                         [(book['id'], book['score'])
+                          for book in response.data['results']])
+        self.assertIsNone(response.data['next'])
+
+    def test_empty_and_unknown(self):
+        response = self.client.get(
+            reverse('book-leaderboard', args=('top_rated',)))
+        self.assertEqual([], response.data['results'])
+        response = self.client.get('/book/leaderboards/worst/')
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class BooksSimilarApiTestCase(APITestCase):
+    def setUp(self):
+        users = [User.objects.create(username=f'test_username{i}')
+                 for i in range(2)]
+        self.books = [Book.objects.create(name=f'Test Book {i}', price=500,
+                                          author_name='Author1')
+                      for i in range(3)]
+        for user in users:
+            for book in self.books[:2]:
+                UserBookRelation.objects.create(user=user, book=book,
+                                                like=True)
+        rebuild_similar_books()
+
+    def test_get(self):
+        url = reverse('book-similar', args=(self.books[0].id,))
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([{
+            'book': {'id': self.books[1].id, 'name': 'Test Book 1',
+                     'author_name': 'Author1', 'price': '500.00',
+                     'rating': None},
+            'score': 1.0,
+        }], json.loads(response.content))
+
+    def test_get_empty_and_not_found(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                reverse('book-similar', args=(self.books[2].id,)))
+        self.assertEqual([], response.data)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('book-similar', args=(0,)))
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class UserLibraryApiTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username1')
+        user2 = User.objects.create(username='test_username2')
+        self.books = [Book.objects.create(name=f'Test Book {i}', price=500,
+                                          author_name='Author1')
+                      for i in range(5)]
+        for i, book in enumerate(self.books):
+            UserBookRelation.objects.create(user=self.user, book=book,
+                                            like=i % 2 == 0,
+                                            in_bookmarks=i == 1, rate=i or None)
+        UserBookRelation.objects.create(user=user2, book=self.books[1],
+                                        like=True)
+
+    def test_get(self):
+        url = reverse('library-list')
+        self.client.force_login(self.user)
+        # session, user and one page of relations with books
+        with self.assertNumQueries(3):
+            response = self.client.get(url, data={'page_size': 2})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([{
+            'book': {'id': self.books[4].id, 'name': 'Test Book 4',
+                     'author_name': 'Author1', 'price': '500.00',
+                     'rating': '4.00'},
+            'like': True, 'in_bookmarks': False, 'rate': 4,
+        }, {
+            'book': {'id': self.books[3].id, 'name': 'Test Book 3',
+                     'author_name': 'Author1', 'price': '500.00',
+                     'rating': '3.00'},
+            'like': False, 'in_bookmarks': False, 'rate': 3,
+        }], response.data['results'])
+
+        with self.assertNumQueries(3):
+            response = self.client.get(response.data['next'])
+        self.assertEqual([self.books[2].id, self.books[1].id],
+                         [item['book']['id']
+                          for item in response.data['results']])
+
+    def test_filter(self):
+        url = reverse('library-list')
+        self.client.force_login(self.user)
+        response = self.client.get(url, data={'like': 'true'})
+        self.assertEqual([book.id for book in self.books[::-2]],
+                         [item['book']['id']
+                          for item in response.data['results']])
+        response = self.client.get(url, data={'in_bookmarks': 'true'})
+        self.assertEqual([self.books[1].id],
+                         [item['book']['id']
+                          for item in response.data['results']])
+        response = self.client.get(url, data={'rate': 3})
+        self.assertEqual([self.books[3].id],
+                         [item['book']['id']
+                          for item in response.data['results']])
+
+    def test_anonymous(self):
+        response = self.client.get(reverse('library-list'))
+        self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+
+@override_settings(STORE_READ_REPLICAS=['replica_1', 'replica_2'])
+class ReplicaRoutingApiTestCase(APITestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = ReplicaRoutingMiddleware(self.get_response)
+
+    def get_response(self, request):
+        response = HttpResponse()
+        response.databases = (router.db_for_read(Book),
+                              router.db_for_read(User),
+                              router.db_for_write(Book))
+        return response
+
+    def test_safe_methods(self):
+        databases = [self.middleware(self.factory.get('/book/')).databases
+                     for _ in range(3)]
+        replicas = [book_db for book_db, user_db, write_db in databases]
+        self.assertEqual({'replica_1', 'replica_2'}, set(replicas[:2]))
+        self.assertEqual(replicas[0], replicas[2])
+        self.assertEqual({('default', 'default')},
+                         {databases[1:] for databases in databases})
+        self.assertEqual('default', router.db_for_read(Book))
+
+    def test_sticky_after_write(self):
+        response = self.middleware(self.factory.patch('/book_relation/1/'))
+        self.assertEqual(('default', 'default', 'default'),
+                         response.databases)
+        self.assertIn(ReplicaRoutingMiddleware.cookie_name, response.cookies)
+
+        request = self.factory.get('/book/')
+        request.COOKIES[ReplicaRoutingMiddleware.cookie_name] = '1'
+        self.assertEqual('default', self.middleware(request).databases[0])
+
+    @override_settings(STORE_READ_REPLICAS=[])
+    def test_no_replicas(self):
+        response = self.middleware(self.factory.get('/book/'))
+        self.assertEqual('default', response.databases[0])
+        response = self.middleware(self.factory.post('/book/'))
+        self.assertNotIn(ReplicaRoutingMiddleware.cookie_name,
+                         response.cookies)
+
+
+class LoggingApiTestCase(APITestCase):
+    def setUp(self):
+        self.queue = queue.SimpleQueue()
+        self.handler = ContextQueueHandler(self.queue)
+        self.logger = logging.getLogger('app.store')
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def get_records(self):
+        records = []
+        while not self.queue.empty():
+            records.append(self.queue.get())
+        return records
+
+    def test_request(self):
+        user = User.objects.create(username='test_username')
+        book = Book.objects.create(name='Test Book 1', price=500,
+                                   author_name='Author1')
+        self.client.force_login(user)
+        with override_settings(STORE_RATING_EVENT_SAMPLE_RATE=1):
+            for _ in range(2):
+                self.client.patch(f'/book_relation/{book.id}/',
+                                  data=json.dumps({'rate': 4}),
+                                  content_type='application/json',
+                                  HTTP_X_REQUEST_ID='test-request')
+
+        # the same rate again is not a change
+        event, request, _ = self.get_records()
+        context = {'request_id': 'test-request', 'method': 'PATCH',
+                   'path': f'/book_relation/{book.id}/',
+                   'view': 'UserBookRelationView.partial_update'}
+        self.assertEqual(('rating_changed', context,
+                          {'book': book.id, 'user': user.id, 'old_rate': None,
+                           'new_rate': 4}),
+                         (event.message, event.context, event.data))
+        self.assertEqual(('request', context), (request.message,
+                                                request.context))
+        self.assertEqual({'status': 200, 'user': user.id, 'sql_queries': 5},
+                         {key: request.data[key]
+                          for key in ('status', 'user', 'sql_queries')})
+
+    def test_sampled_event(self):
+        with override_settings(STORE_REQUEST_LOG=False):
+            self.client.get('/book/')
+        for _ in range(10):
+            log_event('test_event', sample_rate=0)
+        self.assertEqual([], self.get_records())
+
+    def test_json_lines_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'store.log')
+            handler = get_queue_handler(filename, max_bytes=300,
+                                        backup_count=5)
+            logger = logging.getLogger('app.store.test')
+            logger.addHandler(handler)
+            token = log_context.set({'request_id': 'test-request'})
+            try:
+                for i in range(5):
+                    logger.info('event %s', i, extra={'data': {'i': i}})
+            finally:
+                log_context.reset(token)
+                logger.removeHandler(handler)
+                handler.writer.stop()
+
+            names = sorted(os.listdir(directory), reverse=True)
+            self.assertGreater(len(names), 1)
+            lines = []
+            for name in names:
+                with open(os.path.join(directory, name)) as file:
+                    lines.extend(json.loads(line) for line in file)
+        self.assertEqual(5, len(lines))
+        self.assertEqual({'request_id': 'test-request', 'name': 'app.store.test',
+                          'levelname': 'INFO', 'message': 'event 4',
+                          'data': {'i': 4}},
+                         {key: value for key, value in lines[-1].items()
+                          if key != 'time'})
+
+
 class BooksRelationApiTestCase(APITestCase):
     def setUp(self):
         self.user = User.objects.create(username='test_username1')
@@ -217,3 +1108,114 @@ class BooksRelationApiTestCase(APITestCase):
         self.assertEqual({'rate': [
             ErrorDetail(string=f'"{data["rate"]}" is not a valid choice.',
                         code='invalid_choice')]}, response.data)
+
+    def test_upsert(self):
+        UserBookRelation.objects.create(user=self.user2, book=self.book_1,
+                                        like=True, rate=5)
+        url = reverse('userbookrelation-detail', args=(self.book_1.id,))
+        self.client.force_login(self.user)
+        # session, user, counters update and relation upsert, the old rate
+        # is read only for sampled events
+        with self.assertNumQueries(4), override_settings(
+                STORE_RATING_EVENT_SAMPLE_RATE=0):
+            response = self.client.patch(
+                url, data=json.dumps({'like': True, 'rate': 2}),
+                content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({'book': self.book_1.id, 'like': True,
+                          'in_bookmarks': False, 'rate': 2}, response.data)
+
+        response = self.client.patch(
+            url, data=json.dumps({'in_bookmarks': True, 'rate': 4}),
+            content_type='application/json')
+        self.assertEqual({'book': self.book_1.id, 'like': True,
+                          'in_bookmarks': True, 'rate': 4}, response.data)
+        response = self.client.patch(url, data=json.dumps({'rate': None}),
+                                     content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+        self.assertEqual(1, UserBookRelation.objects.filter(
+            user=self.user).count())
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.readers_count)
+        self.assertEqual(2, self.book_1.likes_count)
+        self.assertEqual(1, self.book_1.rating_count)
+        self.assertEqual('5.00', str(self.book_1.rating))
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+    def test_upsert_not_found(self):
+        self.client.force_login(self.user)
+        for book in ('1000', 'abc'):
+            response = self.client.patch(f'/book_relation/{book}/',
+                                         data=json.dumps({'like': True}),
+                                         content_type='application/json')
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        self.assertEqual(0, UserBookRelation.objects.count())
+
+    def test_bulk(self):
+        UserBookRelation.objects.create(user=self.user, book=self.book_1,
+                                        like=True, rate=3)
+        UserBookRelation.objects.create(user=self.user2, book=self.book_1,
+                                        rate=5)
+        data = [
+            {'book': self.book_1.id, 'rate': 4},
+            {'book': self.book_2.id, 'like': True},
+            {'book': self.book_1.id, 'in_bookmarks': True},
+            {'book': self.book_2.id, 'rate': 2},
+        ]
+        json_data = json.dumps(data)
+        url = reverse('userbookrelation-bulk')
+        self.client.force_login(self.user)
+        response = self.client.post(url, data=json_data,
+                                    content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual([
+            {'book': self.book_1.id, 'like': True, 'in_bookmarks': True,
+             'rate': 4},
+            {'book': self.book_2.id, 'like': True, 'in_bookmarks': False,
+             'rate': 2},
+        ], response.data)
+
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.likes_count)
+        self.assertEqual(2, self.book_1.readers_count)
+        self.assertEqual('4.50', str(self.book_1.rating))
+        self.book_2.refresh_from_db()
+        self.assertEqual(1, self.book_2.likes_count)
+        self.assertEqual(1, self.book_2.readers_count)
+        self.assertEqual('2.00', str(self.book_2.rating))
+        self.assertEqual(3, UserBookRelation.objects.count())
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+    def test_bulk_queries(self):
+        books = [Book.objects.create(name=f'Test Book {i}', price=500,
+                                     author_name='Author')
+                 for i in range(10)]
+        UserBookRelation.objects.create(user=self.user, book=books[0])
+        data = [{'book': book.id, 'rate': 5} for book in books]
+        url = reverse('userbookrelation-bulk')
+        self.client.force_login(self.user)
+        # session, user, books check, savepoint and its release, then
+        # counters and the upsert of every book
+        with self.assertNumQueries(5 + len(books) * 2), override_settings(
+                STORE_RATING_EVENT_SAMPLE_RATE=0):
+            response = self.client.post(url, data=json.dumps(data),
+                                        content_type='application/json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+    def test_bulk_wrong(self):
+        url = reverse('userbookrelation-bulk')
+        self.client.force_login(self.user)
+        data = [{'book': self.book_1.id, 'rate': 100}]
+        response = self.client.post(url, data=json.dumps(data),
+                                    content_type='application/json')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual([{'rate': [ErrorDetail(
+            string='"100" is not a valid choice.', code='invalid_choice')]}],
+            response.data)
+
+        data = [{'book': 1000, 'like': True}]
+        response = self.client.post(url, data=json.dumps(data),
+                                    content_type='application/json')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertEqual(0, UserBookRelation.objects.count())
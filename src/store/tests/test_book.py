@@ -1,8 +1,28 @@
 from django.contrib.auth.models import User
-from django.test import TestCase
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import timedelta
+from unittest import mock
 
-from store.models import Book, UserBookRelation
-from store.services.book import set_rating
+from django.contrib import admin
+from django.db import (IntegrityError, OperationalError, connection,
+                       transaction)
+from django.test import (RequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.utils import timezone
+
+from store.admin import BookAdmin, UserBookRelationAdmin
+from store.models import (Book, BookActivity, BookRanking, SimilarBook,
+                          UserBookRelation)
+from store.services.leaderboard import (rankings_worker, rebuild_leaderboards,
+                                        refresh_rankings)
+from store.services.recommendations import rebuild_similar_books
+from store.services.relation import upsert_relation
+from store.writes import CoalescingWorker, WriteCoordinator
+from store.services.book import (set_rating, reconcile_ratings, backfill_likes,
+                                 get_readers_preview, recompute_counters,
+                                 counters_worker)
 
 
 class BookTestCase(TestCase):
@@ -21,3 +41,394 @@ class BookTestCase(TestCase):
         set_rating(self.book_1)
         self.book_1.refresh_from_db()
         self.assertEqual('4.50', str(self.book_1.rating))
+
+    def test_unique_relation(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UserBookRelation.objects.create(user=self.user_1, book=self.book_1)
+
+    def test_edit_keeps_counters(self):
+        book = Book.objects.get(id=self.book_1.id)
+        user = User.objects.create(username='test_username3')
+        UserBookRelation.objects.create(user=user, book=self.book_1,
+                                        like=True, rate=3)
+        book.name = 'Test Book 1 Edited'
+        book.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual('Test Book 1 Edited', self.book_1.name)
+        self.assertEqual((3, 3, 12), (self.book_1.readers_count,
+                                      self.book_1.likes_count,
+                                      self.book_1.rating_sum))
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+        request = RequestFactory().get('/')
+        request.user = User.objects.create(username='admin', is_staff=True,
+                                           is_superuser=True)
+        form = BookAdmin(Book, admin.site).get_form(request)()
+        self.assertEqual({'name', 'price', 'author_name', 'owner'},
+                         set(form.fields))
+
+    def test_bulk_delete(self):
+        UserBookRelationAdmin(UserBookRelation, admin.site).delete_queryset(
+            None, UserBookRelation.objects.filter(user=self.user_1))
+        self.book_1.refresh_from_db()
+        self.assertEqual((1, 1, '4.00'), (self.book_1.readers_count,
+                                          self.book_1.likes_count,
+                                          str(self.book_1.rating)))
+
+        self.user_2.delete()
+        self.book_1.refresh_from_db()
+        self.assertEqual((0, 0, None), (self.book_1.readers_count,
+                                        self.book_1.likes_count,
+                                        self.book_1.rating))
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+    def test_recompute_counters(self):
+        Book.objects.update(readers_count=0, likes_count=5, rating_sum=1,
+                            rating_count=1, rating=1, rate_5_count=0)
+        with self.assertNumQueries(2):
+            recompute_counters([self.book_1.id])
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.readers_count)
+        self.assertEqual(2, self.book_1.likes_count)
+        self.assertEqual('4.50', str(self.book_1.rating))
+        self.assertEqual(1, self.book_1.rate_5_count)
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+    def test_rating_counters(self):
+        self.book_1.refresh_from_db()
+        self.assertEqual(9, self.book_1.rating_sum)
+        self.assertEqual(2, self.book_1.rating_count)
+        self.assertEqual('4.50', str(self.book_1.rating))
+
+    def test_change_rate(self):
+        relation = UserBookRelation.objects.get(user=self.user_2, book=self.book_1)
+        relation.rate = 2
+        with self.assertNumQueries(2):
+            relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual(7, self.book_1.rating_sum)
+        self.assertEqual(2, self.book_1.rating_count)
+        self.assertEqual('3.50', str(self.book_1.rating))
+
+    def test_clear_rate(self):
+        relation = UserBookRelation.objects.get(user=self.user_2, book=self.book_1)
+        relation.rate = None
+        relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual(5, self.book_1.rating_sum)
+        self.assertEqual(1, self.book_1.rating_count)
+        self.assertEqual('5.00', str(self.book_1.rating))
+
+        UserBookRelation.objects.get(user=self.user_1, book=self.book_1).delete()
+        self.book_1.refresh_from_db()
+        self.assertEqual(0, self.book_1.rating_sum)
+        self.assertEqual(0, self.book_1.rating_count)
+        self.assertIsNone(self.book_1.rating)
+
+    def test_rating_histogram(self):
+        self.book_1.refresh_from_db()
+        self.assertEqual({1: 0, 2: 0, 3: 0, 4: 1, 5: 1},
+                         self.book_1.rating_histogram)
+
+        relation = UserBookRelation.objects.get(user=self.user_2, book=self.book_1)
+        relation.rate = 5
+        relation.save()
+        upsert_relation(User.objects.create(username='test_username3'),
+                        self.book_1.id, {'rate': 1})
+        self.book_1.refresh_from_db()
+        self.assertEqual({1: 1, 2: 0, 3: 0, 4: 0, 5: 2},
+                         self.book_1.rating_histogram)
+        self.assertEqual(11, self.book_1.rating_sum)
+        self.assertEqual(3, self.book_1.rating_count)
+
+        relation.delete()
+        Book.objects.update(rate_2_count=3)
+        self.assertEqual([self.book_1.id], reconcile_ratings())
+        self.book_1.refresh_from_db()
+        self.assertEqual({1: 1, 2: 0, 3: 0, 4: 0, 5: 1},
+                         self.book_1.rating_histogram)
+        self.assertEqual('3.00', str(self.book_1.rating))
+
+    def test_same_rate(self):
+        relation = UserBookRelation.objects.get(user=self.user_2, book=self.book_1)
+        relation.in_bookmarks = True
+        with self.assertNumQueries(1):
+            relation.save()
+
+    def test_reconcile_ratings(self):
+        Book.objects.filter(id=self.book_1.id).update(rating_sum=1, rating_count=1)
+        self.assertEqual([self.book_1.id], reconcile_ratings(fix=False))
+        self.assertEqual([self.book_1.id], reconcile_ratings())
+        self.assertEqual([], reconcile_ratings())
+        self.book_1.refresh_from_db()
+        self.assertEqual(9, self.book_1.rating_sum)
+        self.assertEqual(2, self.book_1.rating_count)
+        self.assertEqual('4.50', str(self.book_1.rating))
+
+    def test_likes_count(self):
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.likes_count)
+
+        relation = UserBookRelation.objects.get(user=self.user_2, book=self.book_1)
+        relation.like = False
+        relation.save()
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.likes_count)
+
+        relation.in_bookmarks = True
+        with self.assertNumQueries(1):
+            relation.save()
+
+        UserBookRelation.objects.get(user=self.user_1, book=self.book_1).delete()
+        self.book_1.refresh_from_db()
+        self.assertEqual(0, self.book_1.likes_count)
+
+    def test_backfill_likes(self):
+        Book.objects.filter(id=self.book_1.id).update(likes_count=0)
+        backfill_likes()
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.likes_count)
+
+    def test_readers_count(self):
+        self.book_1.refresh_from_db()
+        self.assertEqual(2, self.book_1.readers_count)
+
+        UserBookRelation.objects.get(user=self.user_1, book=self.book_1).delete()
+        self.book_1.refresh_from_db()
+        self.assertEqual(1, self.book_1.readers_count)
+
+    def test_readers_preview(self):
+        book_2 = Book.objects.create(name='Test Book 2', price=500,
+                                     author_name='Author2')
+        UserBookRelation.objects.create(user=self.user_2, book=book_2)
+
+        with self.assertNumQueries(1):
+            readers = get_readers_preview([self.book_1.id, book_2.id], size=1)
+        self.assertEqual({self.book_1.id: [self.user_1], book_2.id: [self.user_2]},
+                         readers)
+
+        readers = get_readers_preview([self.book_1.id])
+        self.assertEqual([self.user_1, self.user_2], readers[self.book_1.id])
+
+
+class WriteCoordinatorTestCase(TransactionTestCase):
+    def tearDown(self):
+        # refresh queued leaderboards before the database is flushed
+        rankings_worker.flush()
+
+    def test_concurrent_writes(self):
+        book = Book.objects.create(name='Test Book 1', price=500,
+                                   author_name='Author1')
+        users = [User.objects.create(username=f'test_username{i}')
+                 for i in range(20)]
+        coordinator = WriteCoordinator(wait=0.01)
+
+        def rate(user):
+            return coordinator.submit(upsert_relation, user, book.id,
+                                      {'rate': 4, 'like': True})
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            relations = list(executor.map(rate, users))
+            missing = executor.submit(coordinator.submit, upsert_relation,
+                                      users[0], 1000, {'rate': 1})
+        self.assertEqual([4] * 20, [relation.rate for relation in relations])
+        with self.assertRaises(Book.DoesNotExist):
+            missing.result()
+
+        book.refresh_from_db()
+        self.assertEqual(20, book.readers_count)
+        self.assertEqual(20, book.likes_count)
+        self.assertEqual('4.00', str(book.rating))
+
+    def test_failed_commit(self):
+        coordinator = WriteCoordinator()
+        with mock.patch('store.writes.close_old_connections',
+                        side_effect=OperationalError('disk I/O error')):
+            with self.assertRaises(OperationalError):
+                coordinator.submit(Book.objects.count)
+        # the worker thread survives and commits the next writes
+        self.assertEqual(0, coordinator.submit(Book.objects.count))
+
+    def test_timeout(self):
+        coordinator = WriteCoordinator(timeout=0.1)
+        started, release = threading.Event(), threading.Event()
+        created = []
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            blocked = executor.submit(coordinator.submit, block)
+            started.wait(5)
+            with self.assertRaises(FutureTimeoutError):
+                coordinator.submit(created.append, 1)
+            release.set()
+        # the caller of the running write gave up as well
+        with self.assertRaises(FutureTimeoutError):
+            blocked.result()
+
+        # the timed out write is cancelled, not committed later
+        coordinator.submit(created.append, 2)
+        self.assertEqual([2], created)
+
+    def test_sqlite_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual((1,), cursor.fetchone())
+
+
+@override_settings(STORE_COUNTERS_WRITE_BEHIND=True)
+class CountersWriteBehindTestCase(TransactionTestCase):
+    def setUp(self):
+        self.max_staleness = counters_worker.max_staleness
+        counters_worker.max_staleness = 60
+
+    def tearDown(self):
+        counters_worker.max_staleness = self.max_staleness
+        rankings_worker.flush()
+
+    def test_write_behind(self):
+        book = Book.objects.create(name='Test Book 1', price=500,
+                                   author_name='Author1')
+        users = [User.objects.create(username=f'test_username{i}')
+                 for i in range(3)]
+        for user in users:
+            # BEGIN and the upsert, the book row is not touched
+            with self.assertNumQueries(2), override_settings(
+                    STORE_RATING_EVENT_SAMPLE_RATE=0):
+                upsert_relation(user, book.id, {'rate': 5, 'like': True})
+        UserBookRelation.objects.create(user=users[0], book=Book.objects.create(
+            name='Test Book 2', price=500, author_name='Author1'), rate=3)
+        self.assertEqual(2, len(counters_worker.keys))
+
+        book.refresh_from_db()
+        self.assertEqual(0, book.readers_count)
+        counters_worker.flush()
+        book.refresh_from_db()
+        self.assertEqual(3, book.readers_count)
+        self.assertEqual(3, book.likes_count)
+        self.assertEqual('5.00', str(book.rating))
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+    def test_coalescing(self):
+        calls = []
+        called = threading.Event()
+
+        def func(keys):
+            calls.append(keys)
+            called.set()
+
+        worker = CoalescingWorker(func, max_staleness=0.05)
+        for key in (3, 1, 3, 2, 1):
+            worker.add(key)
+        self.assertTrue(called.wait(5))
+        self.assertEqual([{1: 2, 2: 1, 3: 2}], calls)
+
+    def test_flush_at_exit(self):
+        calls = []
+        with mock.patch('store.writes.atexit.register') as register:
+            worker = CoalescingWorker(calls.append, max_staleness=60)
+        register.assert_called_once_with(worker.flush)
+        worker.add(1)
+        # the hook flushes keys the worker thread is still waiting with
+        register.call_args.args[0]()
+        self.assertEqual([{1: 1}], calls)
+        self.assertEqual({}, worker.keys)
+
+
+@override_settings(STORE_TOP_RATED_MIN_VOTES=2)
+class LeaderboardTestCase(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username=f'test_username{i}')
+                      for i in range(3)]
+        self.book_1 = Book.objects.create(name='Test Book 1', price=500,
+                                          author_name='Author1')
+        self.book_2 = Book.objects.create(name='Test Book 2', price=500,
+                                          author_name='Author2')
+        for user, rate in zip(self.users, (5, 4, 3)):
+            UserBookRelation.objects.create(user=user, book=self.book_1,
+                                            rate=rate, like=True)
+        UserBookRelation.objects.create(user=self.users[0], book=self.book_2,
+                                        rate=5)
+
+    def get_rankings(self):
+        return list(BookRanking.objects.order_by(
+            'board', '-score').values_list('board', 'book', 'score'))
+
+    def test_refresh(self):
+        refresh_rankings({self.book_1.id: 3, self.book_2.id: 1})
+        self.assertEqual([
+            ('most_liked', self.book_1.id, 3),
+            ('top_rated', self.book_1.id, 4),
+            ('trending', self.book_1.id, 3),
+            ('trending', self.book_2.id, 1),
+        ], self.get_rankings())
+
+        UserBookRelation.objects.create(user=self.users[1], book=self.book_2,
+                                        rate=4)
+        refresh_rankings({self.book_2.id: 1})
+        self.assertEqual([
+            ('most_liked', self.book_1.id, 3),
+            ('top_rated', self.book_2.id, 4.5),
+            ('top_rated', self.book_1.id, 4),
+            ('trending', self.book_1.id, 3),
+            ('trending', self.book_2.id, 2),
+        ], self.get_rankings())
+
+    def test_rebuild(self):
+        refresh_rankings({self.book_1.id: 3, self.book_2.id: 1})
+        BookActivity.objects.filter(book=self.book_2).update(
+            hour=timezone.now() - timedelta(days=2))
+        self.assertEqual(3, rebuild_leaderboards())
+        self.assertEqual([
+            ('most_liked', self.book_1.id, 3),
+            ('top_rated', self.book_1.id, 4),
+            ('trending', self.book_1.id, 3),
+        ], self.get_rankings())
+        self.assertEqual(1, BookActivity.objects.count())
+
+
+class SimilarBooksTestCase(TestCase):
+    def setUp(self):
+        users = [User.objects.create(username=f'test_username{i}')
+                 for i in range(3)]
+        self.books = [Book.objects.create(name=f'Test Book {i}', price=500,
+                                          author_name='Author1')
+                      for i in range(4)]
+        book_1, book_2, book_3, book_4 = self.books
+        for user in users[:2]:
+            UserBookRelation.objects.create(user=user, book=book_1, like=True)
+            UserBookRelation.objects.create(user=user, book=book_2, like=True)
+        UserBookRelation.objects.create(user=users[2], book=book_1, rate=3)
+        UserBookRelation.objects.create(user=users[2], book=book_3, like=True)
+        # a bad rate is not a signal
+        UserBookRelation.objects.create(user=users[0], book=book_4, rate=2)
+
+    def get_similar_books(self):
+        return [(similar.book_id, similar.similar_id, round(similar.score, 3))
+                for similar in SimilarBook.objects.order_by('book', '-score')]
+
+    def test_rebuild(self):
+        book_1, book_2, book_3, _ = self.books
+        sizes = rebuild_similar_books()
+        self.assertGreaterEqual(sizes.pop('swap_seconds'), 0)
+        self.assertEqual({'relations': 6, 'users': 3, 'books': 3,
+                          'matrix_nonzeros': 6, 'similar_books': 4}, sizes)
+        self.assertEqual([
+            (book_1.id, book_2.id, 0.973),
+            (book_1.id, book_3.id, 0.229),
+            (book_2.id, book_1.id, 0.973),
+            (book_3.id, book_1.id, 0.229),
+        ], self.get_similar_books())
+
+    def test_rebuild_top_k_and_books(self):
+        book_1, book_2, book_3, _ = self.books
+        rebuild_similar_books(top_k=1)
+        UserBookRelation.objects.filter(book=book_3).delete()
+        sizes = rebuild_similar_books([book_1.id, book_3.id], top_k=2)
+        self.assertEqual(1, sizes['books'])
+        self.assertEqual([
+            (book_1.id, book_2.id, 0.973),
+            (book_2.id, book_1.id, 0.973),
+        ], self.get_similar_books())
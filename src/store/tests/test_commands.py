@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from store.models import Book, SimilarBook, UserBookRelation
+from store.services.book import reconcile_ratings
+
+
+class ImportBooksTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='test_username')
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'w') as file:
+            file.write(content)
+        return path
+
+    def test_csv(self):
+        path = self.write('books.csv', 'name,price,author_name\n'
+                                       'Test Book 1,500,Author1\n'
+                                       'Test Book 2,wrong,Author2\n'
+                                       'Test Book 3,700,Author3\n')
+        rejects = os.path.join(self.dir.name, 'rejects.jsonl')
+        out = StringIO()
+        call_command('import_books', path, batch_size=1, owner='test_username',
+                     rejects=rejects, stdout=out)
+
+        self.assertIn('3 rows: 2 created, 0 updated, 1 rejected', out.getvalue())
+        self.assertEqual([('Test Book 1', 500, self.user),
+                          ('Test Book 3', 700, self.user)],
+                         [(book.name, book.price, book.owner)
+                          for book in Book.objects.order_by('id')])
+        with open(rejects) as file:
+            rejected = json.loads(file.read())
+        self.assertEqual(2, rejected['row'])
+        self.assertEqual(['A valid number is required.'],
+                         rejected['errors']['price'])
+
+    def test_jsonl_upsert(self):
+        Book.objects.create(name='Test Book 1', price=500, author_name='Author1')
+        path = self.write('books.jsonl', '\n'.join([
+            json.dumps({'name': 'Test Book 1', 'price': 600,
+                        'author_name': 'Author1'}),
+            json.dumps({'name': 'Test Book 1', 'price': 800,
+                        'author_name': 'Author2'}),
+            '{not json',
+            json.dumps({'name': 'Test Book 3', 'author_name': 'Author1'}),
+        ]))
+        out = StringIO()
+        call_command('import_books', path, upsert=True, stdout=out)
+
+        self.assertIn('4 rows: 1 created, 1 updated, 2 rejected', out.getvalue())
+        self.assertEqual([('Test Book 1', 'Author1', 600),
+                          ('Test Book 1', 'Author2', 800)],
+                         [(book.name, book.author_name, book.price)
+                          for book in Book.objects.order_by('id')])
+
+    def test_upsert_duplicates(self):
+        Book.objects.create(name='Test Book 1', price=500, author_name='Author1')
+        path = self.write('books.csv', 'name,price,author_name\n'
+                                       'Test Book 1,600,Author1\n'
+                                       'Test Book 2,700,Author2\n'
+                                       'Test Book 1,650,Author1\n'
+                                       'Test Book 2,750,Author2\n')
+        out = StringIO()
+        call_command('import_books', path, upsert=True, stdout=out)
+
+        self.assertIn('4 rows: 1 created, 3 updated, 0 rejected', out.getvalue())
+        self.assertEqual([('Test Book 1', 650), ('Test Book 2', 750)],
+                         [(book.name, book.price)
+                          for book in Book.objects.order_by('id')])
+
+
+class ExportBooksTestCase(TestCase):
+    def test_csv(self):
+        book = Book.objects.create(name='Test Book 1', price=500,
+                                   author_name='Author1')
+        out = StringIO()
+        call_command('export_books', format='csv', stdout=out)
+        self.assertEqual(
+            'id,name,price,author_name,annotated_likes,rating,owner_name,'
+            'readers_count\r\n'
+            f'{book.id},Test Book 1,500.00,Author1,0,,,0\r\n',
+            out.getvalue())
+
+
+class SeedLibraryTestCase(TestCase):
+    def test_seed(self):
+        call_command('seed_library', users=20, books=30, relations=200,
+                     seed=1, stdout=StringIO())
+        self.assertEqual(20, User.objects.count())
+        self.assertEqual(30, Book.objects.count())
+        relations_count = UserBookRelation.objects.count()
+        self.assertEqual(relations_count,
+                         UserBookRelation.objects.values(
+                             'user', 'book').distinct().count())
+        self.assertLessEqual(relations_count, 200)
+
+        books = Book.objects.order_by('-readers_count')
+        self.assertGreater(books[0].readers_count, books[29].readers_count)
+        self.assertEqual(relations_count,
+                         sum(book.readers_count for book in books))
+        self.assertEqual(
+            UserBookRelation.objects.filter(like=True).count(),
+            sum(book.likes_count for book in books))
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+
+class ReconcileRatingsTestCase(TestCase):
+    def test_counters(self):
+        user = User.objects.create(username='test_username')
+        book = Book.objects.create(name='Test Book 1', price=500,
+                                   author_name='Author1')
+        UserBookRelation.objects.create(user=user, book=book, like=True,
+                                        rate=4)
+        # counters of a write-behind batch lost with the process
+        Book.objects.update(readers_count=0, likes_count=0, rating_count=0,
+                            rating_sum=0, rate_4_count=0, rating=None)
+
+        out = StringIO()
+        call_command('reconcile_ratings', counters=True, stdout=out)
+        self.assertIn('Counters are recomputed for 1 books', out.getvalue())
+        book.refresh_from_db()
+        self.assertEqual((1, 1, '4.00'), (book.readers_count,
+                                          book.likes_count, str(book.rating)))
+        self.assertEqual([], reconcile_ratings(fix=False))
+
+
+class RebuildSimilarBooksTestCase(TestCase):
+    def test_trace_memory(self):
+        user = User.objects.create(username='test_username')
+        for i in range(2):
+            UserBookRelation.objects.create(user=user, like=True,
+                                            book=Book.objects.create(
+                                                name=f'Test Book {i}',
+                                                price=500,
+                                                author_name='Author1'))
+        out = StringIO()
+        call_command('rebuild_similar_books', trace_memory=True, stdout=out)
+        self.assertIn('rebuilt with 2 rows for 2 books', out.getvalue())
+        self.assertIn('Traced rebuild: peak memory', out.getvalue())
+        self.assertEqual(2, SimilarBook.objects.count())
+
+
+class BenchmarkApiTestCase(TestCase):
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('benchmark_api', scale='1k', requests=3, warmup=1,
+                     scenario=['list', 'filter', 'detail', 'relation_patch'],
+                     stdout=out, stderr=StringIO())
+        results = json.loads(out.getvalue())
+        self.assertEqual(1000, results['books'])
+        self.assertEqual({'list', 'filter', 'detail', 'relation_patch'},
+                         set(results['scenarios']))
+        for result in results['scenarios'].values():
+            self.assertEqual([200], result['statuses'])
+            self.assertGreater(result['queries'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
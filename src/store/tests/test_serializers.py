@@ -1,9 +1,12 @@
 from django.contrib.auth.models import User
 from django.db.models import Count, Case, When, Avg
 from django.test import TestCase
+from rest_framework.renderers import JSONRenderer
 
 from store.models import Book, UserBookRelation
+from store.fast_serializers import get_book_list_values, serialize_book_list
 from store.serializers import BooksSerializer, UserBookRelationSerializer
+from store.views import BookViewSet
 
 
 class BookSerializerTestCase(TestCase):
@@ -31,11 +34,13 @@ class BookSerializerTestCase(TestCase):
         UserBookRelation.objects.create(user=user2, book=book_2, like=True, rate=3)
         UserBookRelation.objects.create(user=user3, book=book_2, like=False)
 
-        books = Book.objects.all().annotate(
+        books = Book.objects.select_related('owner').annotate(
             annotated_likes=Count(Case(When(
                 userbookrelation__like=True, then=1)))).order_by('id')
 
-        data = BooksSerializer(books, many=True).data
+        # the books with owners and the readers previews of the whole page
+        with self.assertNumQueries(2):
+            data = BooksSerializer(books, many=True).data
         expected_data = [
             {
                 'id': book_1.id,
@@ -45,6 +50,7 @@ class BookSerializerTestCase(TestCase):
                 'annotated_likes': 3,
                 'rating': '4.67',
                 'owner_name': 'test_user1',
+                'readers_count': 3,
                 'readers': [
                     {'first_name': 'Ivan', 'last_name': 'One'},
                     {'first_name': 'Anton', 'last_name': 'Two'},
@@ -59,6 +65,7 @@ class BookSerializerTestCase(TestCase):
                 'annotated_likes': 2,
                 'rating': '3.50',
                 'owner_name': '',
+                'readers_count': 3,
                 'readers': [
                     {'first_name': 'Ivan', 'last_name': 'One'},
                     {'first_name': 'Anton', 'last_name': 'Two'},
@@ -69,6 +76,12 @@ class BookSerializerTestCase(TestCase):
         print(data)
         self.assertEqual(expected_data, data)
 
+        rows = get_book_list_values(BookViewSet.queryset.order_by('id'))
+        fast_data = serialize_book_list(list(rows))
+        self.assertEqual(expected_data, fast_data)
+        self.assertEqual(JSONRenderer().render(data),
+                         JSONRenderer().render(fast_data))
+
 
 class UserBookRelationSerializerTestCase(TestCase):
     def test_ok(self):
@@ -1,32 +1,269 @@
-from django.db.models import Count, Case, When, Avg, F
+from django.db.models import F
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.filters import SearchFilter, OrderingFilter
-from rest_framework.mixins import UpdateModelMixin
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.filters import OrderingFilter
+from rest_framework.mixins import ListModelMixin, UpdateModelMixin
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, GenericViewSet
 
-from store.models import Book, UserBookRelation
+from store.cache import (cache_books_response, cache_stats, get_books_version,
+                         get_or_set_books_data)
+from store.conditional import conditional_response, get_etag
+from store.fast_serializers import get_book_list_values, serialize_book_list
+from store.metrics import measure_serialization, registry
+from store.models import Book, BookRanking, SimilarBook, UserBookRelation
+from store.pagination import (KeysetPagination, LeaderboardPagination,
+                              ReadersPagination)
 from store.permissions import IsOwnerOrStaffOrReadOnly
-from store.serializers import BooksSerializer, UserBookRelationSerializer
+from store.routers import reads_from_replicas
+from store.search import BookSearchFilter
+from store.serializers import (BOOK_FIELD_VALUES, BookDetailSerializer,
+                               BookReaderRelationSerializer, BooksSerializer,
+                               LibraryBookSerializer,
+                               SimilarBookSerializer,
+                               UserBookRelationBulkSerializer,
+                               UserBookRelationSerializer,
+                               UserLibrarySerializer)
+from store.services.export import CONTENT_TYPES, export_books
+from store.services.facets import get_facets
+from store.services.recommendations import TOP_K
+from store.services.relation import (RELATION_FIELDS, bulk_update_relations,
+                                     upsert_relation)
+from store.writes import run_write
 
 
 class BookViewSet(ModelViewSet):
     queryset = Book.objects.all().annotate(
-        annotated_likes=Count(Case(When(userbookrelation__like=True, then=1))),
         owner_name=F('owner__username'),
-    ).select_related('owner').prefetch_related('readers')
+    ).select_related('owner')
     serializer_class = BooksSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    pagination_class = KeysetPagination
+    filter_backends = [DjangoFilterBackend, BookSearchFilter, OrderingFilter]
     permission_classes = [IsOwnerOrStaffOrReadOnly]
     filter_fields = ['price']
     search_fields = ['name', 'author_name']
     ordering_fields = ['price', 'author_name']
+    facet_names = ('author_name', 'price')
+
+    def get_sparse_fields(self):
+        """
+        Output fields requested by `?fields=` and not excluded by `?omit=`,
+        comma separated, or None for all fields
+        """
+        if hasattr(self, '_sparse_fields'):
+            return self._sparse_fields
+        self._sparse_fields = None
+        params = self.request.query_params
+        if self.action not in ('list', 'retrieve') or not (
+                'fields' in params or 'omit' in params):
+            return None
+
+        all_fields = self.get_serializer_class().Meta.fields
+        requested = {}
+        for param in ('fields', 'omit'):
+            names = [name.strip() for name in params.get(param, '').split(',')
+                     if name.strip()]
+            unknown = [name for name in names if name not in all_fields]
+            if unknown:
+                raise ValidationError({param: [
+                    f'Unknown fields: {", ".join(unknown)}. '
+                    f'Choose from: {", ".join(all_fields)}.']})
+            requested[param] = names
+        fields = requested['fields'] or all_fields
+        self._sparse_fields = [field for field in all_fields
+                               if field in fields
+                               and field not in requested['omit']]
+        return self._sparse_fields
+
+    def get_queryset(self):
+        """
+        Books with only the joins and columns needed by the requested fields
+        """
+        fields = self.get_sparse_fields()
+        if fields is None:
+            return super().get_queryset()
+        books = Book.objects.all()
+        columns = {column for field in fields
+                   for column in BOOK_FIELD_VALUES[field]}
+        if 'owner_name' in fields:
+            # the annotation for values() rows, the owner for instances
+            books = books.annotate(
+                owner_name=F('owner__username'),
+            ).select_related('owner')
+            columns.remove('owner_name')
+            columns.update(('owner', 'owner__username'))
+        return books.only('id', *columns)
+
+    def get_serializer_class(self):
+        if self.action == 'retrieve':
+            return BookDetailSerializer
+        return super().get_serializer_class()
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in ('list', 'retrieve'):
+            kwargs.setdefault('fields', self.get_sparse_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    @conditional_response('get_list_validators')
+    @cache_books_response
+    def list(self, request, *args, **kwargs):
+        fields = self.get_sparse_fields()
+        books = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(get_book_list_values(books, fields))
+        with measure_serialization(request):
+            data = serialize_book_list(page, fields)
+        return self.get_paginated_response(data)
+
+    @conditional_response('get_detail_validators')
+    @cache_books_response
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        with measure_serialization(request):
+            data = self.get_serializer(instance).data
+        return Response(data)
+
+    def get_list_validators(self, request, *args, **kwargs):
+        """
+        The books version changes on every write of a book or relation,
+        so the list ETag costs one cache read and no query. It is bumped on
+        the primary database at once, a lagging replica would send old data
+        under the new ETag, so lists read from replicas have no validators
+        """
+        if reads_from_replicas():
+            return None
+        return get_etag(request.get_full_path(), get_books_version()), None
+
+    def get_detail_validators(self, request, *args, **kwargs):
+        try:
+            last_modified = Book.objects.filter(
+                pk=kwargs['pk']).values_list('updated_at', flat=True).first()
+        except ValueError:
+            return None
+        if last_modified is None:
+            return None
+        return (get_etag(request.get_full_path(), last_modified),
+                last_modified)
 
     def perform_create(self, serializer):
         serializer.validated_data['owner'] = self.request.user
         serializer.save()
 
+    @action(detail=True)
+    def readers(self, request, pk=None):
+        book = self.get_object()
+        relations = UserBookRelation.objects.filter(
+            book=book,
+        ).select_related('user').only(
+            'user', 'user__first_name', 'user__last_name',
+        ).order_by('id')
+        paginator = ReadersPagination()
+        page = paginator.paginate_queryset(relations, request, view=self)
+        serializer = BookReaderRelationSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True)
+    def similar(self, request, pk=None):
+        """
+        Books liked by readers of the book, precomputed by
+        rebuild_similar_books, so it is one lookup by the book index.
+        Similar books are left joined to the book, a book without them is
+        one row of nulls and a missing book is no row, in the same query
+        """
+        fields = LibraryBookSerializer.Meta.fields
+        try:
+            rows = list(Book.objects.filter(pk=pk).values_list(
+                'similar_books__score',
+                *(f'similar_books__similar__{field}' for field in fields),
+            ).order_by('-similar_books__score')[:TOP_K])
+        except ValueError:
+            raise NotFound()
+        if not rows:
+            raise NotFound()
+        similar_books = [
+            SimilarBook(score=score, similar=Book(**dict(zip(fields, values))))
+            for score, *values in rows if score is not None]
+        return Response(SimilarBookSerializer(similar_books, many=True).data)
+
+    @action(detail=False, url_path='leaderboards/(?P<board>{})'.format(
+        '|'.join(board for board, _ in BookRanking.BOARD_CHOICES)))
+    def leaderboard(self, request, board):
+        books = self.get_queryset().filter(rankings__board=board).annotate(
+            score=F('rankings__score'), ranking_book=F('rankings__book'),
+        ).order_by('-score', '-ranking_book')
+        paginator = LeaderboardPagination()
+        page = paginator.paginate_queryset(get_book_list_values(books),
+                                           request, view=self)
+        with measure_serialization(request):
+            data = serialize_book_list(page)
+        for item, row in zip(data, page):
+            item['score'] = row['score']
+        return paginator.get_paginated_response(data)
+
+    @action(detail=False)
+    def facets(self, request):
+        """
+        Counts of books found by the filters and search of the list by
+        author and by price range, `?facets=` selects facets.
+        Cached by the filter params only, so ordering and pages of the list
+        share facets
+        """
+        names = [name.strip()
+                 for name in request.query_params.get('facets', '').split(',')
+                 if name.strip()] or list(self.facet_names)
+        unknown = [name for name in names if name not in self.facet_names]
+        if unknown:
+            raise ValidationError({'facets': [
+                f'Unknown facets: {", ".join(unknown)}. '
+                f'Choose from: {", ".join(self.facet_names)}.']})
+
+        filter_param_names = {BookSearchFilter.search_param,
+                              *self.filter_fields}
+        filter_params = [(name, value) for name in request.query_params
+                         if name in filter_param_names
+                         for value in request.query_params.getlist(name)]
+        facets = get_or_set_books_data(
+            'facets', filter_params, self.get_facets_data)
+        return Response({'count': facets['count'],
+                         **{name: facets[name] for name in names}})
+
+    def get_facets_data(self):
+        facets = get_facets(self.filter_queryset(Book.objects.all()),
+                            settings.STORE_PRICE_FACET_BOUNDS,
+                            settings.STORE_AUTHOR_FACET_SIZE)
+        price_to_representation = BooksSerializer().fields[
+            'price'].to_representation
+        for price_range in facets['price']:
+            for bound in ('from', 'to'):
+                if price_range[bound] is not None:
+                    price_range[bound] = price_to_representation(
+                        price_range[bound])
+        return facets
+
+    @action(detail=False)
+    def export(self, request):
+        output_format = request.query_params.get('output', 'jsonl')
+        if output_format not in CONTENT_TYPES:
+            raise ValidationError({'output': [
+                f'Choose one of: {", ".join(CONTENT_TYPES)}.']})
+        books = self.filter_queryset(Book.objects.all())
+        response = StreamingHttpResponse(
+            export_books(books, output_format),
+            content_type=CONTENT_TYPES[output_format])
+        response['Content-Disposition'] = (
+            f'attachment; filename="books.{output_format}"')
+        return response
+
+    @action(detail=False, permission_classes=[IsAdminUser])
+    def cache_stats(self, request):
+        return Response({**cache_stats.as_dict(),
+                         'version': get_books_version()})
+
 
 class UserBookRelationView(UpdateModelMixin, GenericViewSet):
     queryset = UserBookRelation.objects.all()
@@ -34,10 +271,58 @@ class UserBookRelationView(UpdateModelMixin, GenericViewSet):
     permission_classes = [IsAuthenticated]
     lookup_field = 'book'
 
-    def get_object(self):
-        obj, _ = UserBookRelation.objects.get_or_create(user=self.request.user,
-                                                        book_id=self.kwargs['book'])
-        return obj
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        serializer = self.get_serializer(data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        fields = {field: value
+                  for field, value in serializer.validated_data.items()
+                  if field in RELATION_FIELDS}
+        try:
+            relation = run_write(upsert_relation, request.user,
+                                 int(self.kwargs['book']), fields)
+        except (ValueError, Book.DoesNotExist):
+            raise NotFound
+        return Response(self.get_serializer(relation).data)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        serializer = UserBookRelationBulkSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        relations = run_write(bulk_update_relations, request.user,
+                              serializer.validated_data)
+        return Response(UserBookRelationSerializer(relations, many=True).data)
+
+class UserLibraryView(ListModelMixin, GenericViewSet):
+    """Books liked, bookmarked or rated by the current user"""
+    serializer_class = UserLibrarySerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    filter_backends = [DjangoFilterBackend]
+    filter_fields = ['like', 'in_bookmarks', 'rate']
+
+    def get_queryset(self):
+        return UserBookRelation.objects.filter(
+            user=self.request.user,
+        ).select_related('book').only(
+            'like', 'in_bookmarks', 'rate', 'book__name',
+            'book__author_name', 'book__price', 'book__rating',
+        ).order_by('-id')
+
 
 def auth(request):
     return render(request, 'oauth.html')
+
+
+def metrics(request):
+    if (request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS
+            and not request.user.is_staff):
+        raise PermissionDenied
+    cache = cache_stats.as_dict()
+    content = registry.render() + (
+        '# TYPE store_books_cache_hits_total counter\n'
+        f'store_books_cache_hits_total {cache["hits"]}\n'
+        '# TYPE store_books_cache_misses_total counter\n'
+        f'store_books_cache_misses_total {cache["misses"]}\n'
+    )
+    return HttpResponse(content, content_type='text/plain; version=0.0.4')
@@ -0,0 +1,182 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, TimeoutError
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger('app.store')
+
+
+class WriteCoordinator:
+    """
+    Run writes of all request threads in one worker thread, so SQLite has
+    a single writer and requests never fail with "database is locked".
+    Writes queued while a transaction commits are committed together in
+    the next transaction, one fsync for the whole batch. Every write runs
+    in its own savepoint, so a failed write does not affect the others.
+    A caller waits at most `timeout` seconds: a write still queued then is
+    cancelled, a write already in the running batch may still be committed
+    """
+
+    def __init__(self, batch_size=100, wait=0.002, timeout=30.0):
+        self.batch_size = batch_size
+        self.wait = wait
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, func, *args, **kwargs):
+        """Queue the write, wait for its commit and return its result"""
+        self.start()
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='store-writes')
+                self.thread.start()
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            try:
+                self.commit(batch)
+            except Exception as exc:
+                logger.exception(f'Commit of {len(batch)} writes failed')
+                for future, *_ in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    def get_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(
+                    timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def commit(self, batch):
+        # writes cancelled by a timed out caller are skipped
+        batch = [item for item in batch
+                 if item[0].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        results = []
+        try:
+            close_old_connections()
+            with transaction.atomic():
+                for future, func, args, kwargs in batch:
+                    try:
+                        with transaction.atomic():
+                            results.append((future, func(*args, **kwargs),
+                                            None))
+                    except Exception as exc:
+                        results.append((future, None, exc))
+        except Exception as exc:
+            logger.exception(f'Commit of {len(batch)} writes failed')
+            for future, *_ in batch:
+                future.set_exception(exc)
+            return
+        for future, result, exc in results:
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+
+class CoalescingWorker:
+    """
+    Write-behind worker: writers only add keys, the worker thread calls
+    `func` with all keys added since the last call, in batches of at most
+    `batch_size` keys. A batch is a dict of sorted keys to the number of
+    times they were added. A key added many times is processed once,
+    at most `max_staleness` seconds after it was added first, or earlier
+    when a full batch is waiting. Keys of a failed call are retried.
+    Keys left at exit are flushed by an atexit hook, keys of a crashed
+    process are lost: `manage.py reconcile_ratings --counters` recomputes
+    counters of all books from their relations
+    """
+
+    def __init__(self, func, max_staleness=1.0, batch_size=500):
+        self.func = func
+        self.max_staleness = max_staleness
+        self.batch_size = batch_size
+        self.keys = Counter()
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def add(self, key):
+        with self.condition:
+            self.keys[key] += 1
+            if len(self.keys) >= self.batch_size:
+                self.condition.notify()
+        self.start()
+
+    def start(self):
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='store-write-behind')
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.keys)
+                self.condition.wait_for(
+                    lambda: len(self.keys) >= self.batch_size,
+                    timeout=self.max_staleness)
+            self.flush()
+
+    def flush(self):
+        """
+        Process all added keys now, in the calling thread, after the batch
+        the worker thread may be processing
+        """
+        with self.flush_lock:
+            with self.condition:
+                keys, self.keys = sorted(self.keys.items()), Counter()
+            if not keys:
+                return
+            close_old_connections()
+            for start in range(0, len(keys), self.batch_size):
+                batch = dict(keys[start:start + self.batch_size])
+                try:
+                    self.func(batch)
+                except Exception:
+                    logger.exception(
+                        f'Write-behind of {len(batch)} keys failed')
+                    with self.condition:
+                        self.keys.update(batch)
+
+
+write_coordinator = WriteCoordinator(
+    batch_size=settings.STORE_WRITE_QUEUE_BATCH_SIZE,
+    wait=settings.STORE_WRITE_QUEUE_WAIT,
+    timeout=settings.STORE_WRITE_QUEUE_TIMEOUT,
+)
+
+
+def run_write(func, *args, **kwargs):
+    """Run the write through the write queue if it is enabled"""
+    if settings.STORE_WRITE_QUEUE:
+        return write_coordinator.submit(func, *args, **kwargs)
+    return func(*args, **kwargs)